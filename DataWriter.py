@@ -0,0 +1,303 @@
+#! /usr/bin/env python
+
+import threading
+import inspect
+import logging
+from queue import Queue, Empty, Full
+from datetime import datetime
+from time import perf_counter
+import bpc_store
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+class DataWriter(threading.Thread):
+    """
+    Writes the samples of all controllers to their daily data files from its own thread.
+    The samples are queued by put() without blocking, the daily files are kept open and the
+    lines are written in batches every flush_interval ms or every flush_size lines, whichever
+    comes first. The file of a controller is closed at midnight and the next sample opens the
+    file of the new day. A closed file is never opened again, the late samples of its day, e.g. of
+    a stalled read published after midnight, are dropped and counted. Jobs queued by put_job(), e.g. checkpoints, run in queue order after
+    the samples queued before them were written. on_day_closed(ctrl, fname) is called from the
+    writer thread after the file of a past day was closed. With binlog the samples are also
+    appended to the binary log of fixed size records in the data directory of their controller,
+    with rollup they are added to its 1 min, 1 h and 1 day rollup tiers and with sqlite they are
+    inserted into its sqlite database, one transaction per flush.
+    """
+
+    def __init__(self, maxsize=100000, flush_interval=1000, flush_size=100, binlog=False, rollup=False, \
+                 sqlite=False):
+        threading.Thread.__init__(self, name='DataWriter', daemon=True)
+        self.queue = Queue(maxsize=maxsize)
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # controller: (file name, open file)
+        self.files = {}
+        # controller: lines waiting for the next flush
+        self.pending = {}
+        # controller: name of the last daily file that was closed
+        self.closed = {}
+        self.binlog = binlog
+        # controller: open binary log
+        self.binfiles = {}
+        self.rollup = rollup
+        # controller: bpc_store.Rollups
+        self.rollups = {}
+        self.sqlite = sqlite
+        # controller: bpc_store.SqliteLog
+        self.sqlite_logs = {}
+        self.on_day_closed = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self,):
+        with self.lock:
+            self._reset()
+
+    def _reset(self,):
+        self.t0 = perf_counter()
+        self.lines = 0
+        self.flushes = 0
+        self.dropped = 0
+        self.late = 0
+        self.jobs = 0
+        self.max_backlog = 0
+        self.flush_sum = 0.0
+        self.flush_max = 0.0
+
+    def put(self, sample):
+        """
+        Queues one sample, never blocks. Samples are dropped and counted if the queue is full
+        """
+        try:
+            self.queue.put_nowait(sample)
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def put_job(self, job):
+        """
+        Queues a callable that is run by the writer thread, it blocks if the queue is full
+        """
+        self.queue.put(job)
+
+    def run(self):
+        last_flush = perf_counter()
+        n_pending = 0
+        while True:
+            timeout = max(0.0, self.flush_interval*0.001 - (perf_counter() - last_flush))
+            try:
+                sample = self.queue.get(timeout=timeout)
+            except Empty:
+                sample = False
+            if sample is None:
+                # stop() was called
+                break
+            if callable(sample):
+                if n_pending > 0:
+                    self.flush()
+                    n_pending = 0
+                    last_flush = perf_counter()
+                try:
+                    sample()
+                except Exception as e:
+                    logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+                with self.lock:
+                    self.jobs += 1
+            elif sample is not False:
+                self._add(sample)
+                n_pending += 1
+                backlog = self.queue.qsize()
+                with self.lock:
+                    self.max_backlog = max(self.max_backlog, backlog)
+            if n_pending >= self.flush_size or perf_counter() - last_flush >= self.flush_interval*0.001:
+                if n_pending > 0:
+                    self.flush()
+                self._close_stale()
+                n_pending = 0
+                last_flush = perf_counter()
+        self.flush()
+        self.close()
+
+    def _add(self, sample):
+        if sample.valid():
+            self.pending.setdefault(sample.ctrl, []).append(sample)
+
+    def _file(self, ctrl, fname):
+        """
+        Open daily file of the controller, the file of the previous day is closed
+        """
+        current = self.files.get(ctrl)
+        if current is not None:
+            if current[0] == fname:
+                return current[1]
+            self._close(ctrl)
+        f = open(fname, 'a')
+        self.files[ctrl] = (fname, f)
+        return f
+
+    def _binfile(self, ctrl):
+        f = self.binfiles.get(ctrl)
+        if f is None:
+            f = bpc_store.open_binlog(bpc_store.binlog_name(ctrl.datadir))
+            self.binfiles[ctrl] = f
+        return f
+
+    def flush(self,):
+        """
+        Writes the pending lines of every controller
+        """
+        start = perf_counter()
+        n = 0
+        late = 0
+        for ctrl, samples in self.pending.items():
+            if samples == []:
+                continue
+            try:
+                kept = self._on_time(ctrl, samples)
+                late += len(samples) - len(kept)
+                samples[:] = kept
+                if samples == []:
+                    continue
+                # a batch can span midnight, every line goes to the file of its own day
+                fname = ctrl.data_fname(samples[0].timestamp)
+                lines = []
+                for sample in samples:
+                    name = ctrl.data_fname(sample.timestamp)
+                    if name != fname:
+                        self._file(ctrl, fname).write(''.join(lines))
+                        fname, lines = name, []
+                    lines.append(sample.line())
+                f = self._file(ctrl, fname)
+                f.write(''.join(lines))
+                f.flush()
+                if self.binlog or self.rollup:
+                    recs = bpc_store.records(samples)
+                if self.binlog:
+                    b = self._binfile(ctrl)
+                    b.write(recs.tobytes())
+                    b.flush()
+                if self.rollup:
+                    if ctrl not in self.rollups:
+                        self.rollups[ctrl] = bpc_store.Rollups(ctrl.datadir)
+                    self.rollups[ctrl].add_records(recs)
+                if self.sqlite:
+                    if ctrl not in self.sqlite_logs:
+                        self.sqlite_logs[ctrl] = bpc_store.SqliteLog(bpc_store.sqlite_name(ctrl.datadir))
+                    self.sqlite_logs[ctrl].insert(samples)
+                n += len(samples)
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " " + str(ctrl) + " Exception: " + str(e))
+            samples.clear()
+        elapsed = perf_counter() - start
+        with self.lock:
+            self.lines += n
+            self.late += late
+            self.flushes += 1
+            self.flush_sum += elapsed
+            self.flush_max = max(self.flush_max, elapsed)
+
+    def _on_time(self, ctrl, samples):
+        """
+        The samples of the controller without the late ones, i.e. of a day whose file was closed
+        already or of a day before the one of the open file or of an earlier sample. The file names
+        sort by day
+        """
+        closed = self.closed.get(ctrl, '')
+        newest = self.files[ctrl][0] if ctrl in self.files else ''
+        kept = []
+        for sample in samples:
+            name = ctrl.data_fname(sample.timestamp)
+            if name <= closed or name < newest:
+                continue
+            newest = name
+            kept.append(sample)
+        return kept
+
+    def splice(self, store, datadir, start, archive):
+        """
+        Replaces everything the store, 'binlog' or 'rollup', of the data directory holds before start, ns since
+        the epoch, by the file archive back-filled from the daily files. Runs as a job in the writer
+        thread, so the samples after start that were appended meanwhile are kept
+        """
+        if store == 'binlog':
+            for ctrl in [ctrl for ctrl in self.binfiles if ctrl.datadir == datadir]:
+                self.binfiles.pop(ctrl).close()
+            bpc_store.splice_binlog(bpc_store.binlog_name(datadir), archive, start)
+        elif store == 'rollup':
+            for ctrl, rollups in self.rollups.items():
+                if ctrl.datadir == datadir:
+                    rollups.release()
+            # the records of the buckets completed since start end after it
+            for tier in bpc_store.TIERS:
+                bpc_store.splice_binlog(bpc_store.rollup_name(datadir, tier), bpc_store.rollup_name(datadir, tier) + archive, \
+                                        start, bpc_store.ROLLUP, 'end')
+
+    def _close_stale(self,):
+        """
+        Closes the files of the previous day, e.g. right after midnight
+        """
+        now = datetime.now()
+        for ctrl in list(self.files):
+            if self.files[ctrl][0] != ctrl.data_fname(now):
+                self._close(ctrl)
+
+    def _close(self, ctrl):
+        """
+        Closes the file of a past day of the controller
+        """
+        fname, f = self.files.pop(ctrl)
+        f.close()
+        # its late samples are dropped, so the file is closed only once
+        self.closed[ctrl] = fname
+        if self.on_day_closed is not None:
+            try:
+                self.on_day_closed(ctrl, fname)
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+
+    def close(self,):
+        for f in [f for fname, f in self.files.values()] + list(self.binfiles.values()):
+            try:
+                f.close()
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+        self.files = {}
+        self.binfiles = {}
+        for store in list(self.rollups.values()) + list(self.sqlite_logs.values()):
+            try:
+                store.close()
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+        self.rollups = {}
+        self.sqlite_logs = {}
+
+    def snapshot(self, reset=False):
+        """
+        Writer statistics since the last reset: lines written, flushes, samples dropped, late samples
+        dropped, jobs run, current and maximum queue backlog and the mean and max flush latency in ms
+        """
+        with self.lock:
+            snap = {'seconds': perf_counter() - self.t0,
+                    'lines': self.lines,
+                    'flushes': self.flushes,
+                    'dropped': self.dropped,
+                    'late': self.late,
+                    'jobs': self.jobs,
+                    'backlog': self.queue.qsize(),
+                    'max_backlog': self.max_backlog,
+                    'flush_mean_ms': self.flush_sum/self.flushes*1e3 if self.flushes > 0 else 0.0,
+                    'flush_max_ms': self.flush_max*1e3}
+            # in the same locked section so nothing recorded after the copy is lost
+            if reset:
+                self._reset()
+        return snap
+
+    def stop(self,):
+        """
+        Writes everything queued so far, closes the files and stops the thread
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
@@ -0,0 +1,144 @@
+#! /usr/bin/env python
+
+from math import ceil, exp, sqrt
+from numpy import NaN, arange, full, float64, isnan, sum as np_sum
+
+class RollingStats:
+    """
+    Mean, variance and EWMA of the samples of the last window seconds.
+    The samples are kept in a preallocated ring buffer sized for window/period samples,
+    running sums make every push O(1) regardless of the window length.
+    """
+
+    def __init__(self, window, period=1.0, tau=None):
+        """
+        window: length of the window in s
+        period: expected time between samples in s, sizes the ring buffer
+        tau: time constant of the EWMA in s, defaults to the window
+        """
+        self.window = float(window)
+        self.period = float(period)
+        self.tau = float(tau) if tau is not None else self.window
+        # one extra slot so a full window plus the new sample fits
+        self.capacity = max(2, int(ceil(self.window/self.period)) + 1)
+        self.times = full(self.capacity, NaN, dtype=float64)
+        self.values = full(self.capacity, NaN, dtype=float64)
+        self.clear()
+
+    def clear(self,):
+        self.head = 0
+        self.count = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+        self._ewma = NaN
+        self._last_time = NaN
+        # pushes since the running sums were last recomputed
+        self._pushes = 0
+
+    def __len__(self):
+        return self.count
+
+    def _evict(self,):
+        x = self.values[self.head]
+        self._sum -= x
+        self._sumsq -= x*x
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        if self.count == 0:
+            self._sum = 0.0
+            self._sumsq = 0.0
+
+    def _resum(self,):
+        """
+        Recomputes the running sums from the buffer to drop the accumulated rounding error,
+        done once per buffer length so it is O(1) amortized
+        """
+        if self.count == 0:
+            self._sum = 0.0
+            self._sumsq = 0.0
+        else:
+            idx = (self.head + arange(self.count)) % self.capacity
+            v = self.values[idx]
+            self._sum = float(np_sum(v))
+            self._sumsq = float(np_sum(v*v))
+        self._pushes = 0
+
+    def push(self, t, x):
+        """
+        Adds the sample x taken at the monotonic time t in s, NaN samples are ignored
+        """
+        if isnan(x) or isnan(t):
+            return
+        # drop the samples that fell out of the window
+        while self.count > 0 and t - self.times[self.head] >= self.window:
+            self._evict()
+        # sampling faster than the period the buffer was sized for, drop the oldest
+        if self.count == self.capacity:
+            self._evict()
+        tail = (self.head + self.count) % self.capacity
+        self.times[tail] = t
+        self.values[tail] = x
+        self.count += 1
+        self._sum += x
+        self._sumsq += x*x
+        # time based EWMA, irregular sample spacing is accounted for
+        if isnan(self._ewma):
+            self._ewma = x
+        else:
+            alpha = 1.0 - exp(-max(0.0, t - self._last_time)/self.tau)
+            self._ewma += alpha*(x - self._ewma)
+        self._last_time = t
+        self._pushes += 1
+        if self._pushes >= self.capacity:
+            self._resum()
+
+    def samples(self,):
+        """
+        Returns copies of the times and values in the window, oldest first
+        """
+        idx = (self.head + arange(self.count)) % self.capacity
+        return self.times[idx], self.values[idx]
+
+    def load(self, times, values, ewma=NaN):
+        """
+        Replaces the window with the given samples, e.g. from a checkpoint
+        """
+        self.clear()
+        for t, x in zip(times, values):
+            self.push(t, x)
+        if not isnan(ewma) and self.count > 0:
+            self._ewma = ewma
+
+    @property
+    def mean(self,):
+        if self.count == 0:
+            return NaN
+        return self._sum/self.count
+
+    @property
+    def var(self,):
+        """
+        Sample variance of the window
+        """
+        if self.count < 2:
+            return NaN
+        m = self._sum/self.count
+        return max(0.0, (self._sumsq - self.count*m*m)/(self.count - 1))
+
+    @property
+    def std(self,):
+        v = self.var
+        return v if isnan(v) else sqrt(v)
+
+    @property
+    def ewma(self,):
+        return self._ewma
+
+    @property
+    def span(self,):
+        """
+        Time covered by the samples in the window in s
+        """
+        if self.count == 0:
+            return 0.0
+        return self._last_time - self.times[self.head]
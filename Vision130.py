@@ -2,7 +2,11 @@
 
 import socket # for socket
 import struct
-from numpy import NaN
+import asyncio
+import threading
+from random import uniform
+from time import perf_counter
+from numpy import NaN, frombuffer, full, float64, array, concatenate
 
 # message format: <STX><CC><ADDRESS><LENGTH><CRC><ETX>
 # <STX>: /, <CC>: command code, <CRC>: checksum, <ETX>: end transmission character
@@ -10,92 +14,636 @@ from numpy import NaN
 # message = b'/00RC' # Get TIME
 # message = b'/00RW0000FF'  # Read all int addresses
 # message = b'/00RNF000001' # Read single float address at address 0
+# Every message on the wire is prefixed by a 6 byte PCOM/TCP header:
+# <TRANSACTION ID (2 bytes)><PROTOCOL (0x65 ascii)><0x00><DATA LENGTH (2 bytes)>, little endian
+# replies start with /A instead of / and carry the transaction id of the request
+#
+# binary PCOM (protocol 0x66) frames carry raw little endian operands instead of ascii hex:
+# <STX /_OPLC><UNIT><0xFE><0x01><0x00 0x00 0x00><COMMAND><0x00><SUB COMMAND (6 bytes)>
+# <DATA LENGTH (2 bytes)><HEADER CHECKSUM (2 bytes)><DATA><DATA CHECKSUM (2 bytes)><ETX \>
+# checksums are the two's complement of the byte sum, replies echo the command + 0x80
+HEADER_LEN = 6
+PCOM_ASCII = 0x65
+PCOM_BINARY = 0x66
+# the register count of a RNF command is two hex digits
+MAX_RNF_COUNT = 0xFF
+ETX = b'\r'
+BIN_STX = b'/_OPLC'
+BIN_ETX = b'\\'
+BIN_HEADER_LEN = 24
+# read operands command, a vectorial request is <COUNT (2 bytes)><TYPE | 0x80><0xFF><START (2 bytes)>
+BIN_READ_OPERANDS = 0x4D
+OPERAND_MF = 0x07
+# floats per binary request, 4 bytes each
+MAX_BINARY_COUNT = 0x100
+
+class PcomError(Exception):
+    """
+    Raised when a reply from the PLC is malformed or fails the checksum
+    tid is the transaction id of the offending frame if it is known
+    """
+    def __init__(self, msg, tid=None):
+        super(PcomError, self).__init__(msg)
+        self.tid = tid
+
+class ChecksumError(PcomError):
+    pass
+
+class ShortFrameError(PcomError):
+    """
+    Raised when a reply is cut short or the frame boundaries are lost
+    """
+    pass
+
+def calc_checksum(message, skip=1):
+    """
+    PCOM checksum: sum of all characters after the STX modulo 256 as two hex digits.
+    The STX is one character (/) for commands and two characters (/A) for replies
+    """
+    return '%02X' % (sum(message[skip:]) % 256)
+
+def build_frame(tid, message):
+    """
+    Wraps an ascii command (e.g. b'/00RC') in the PCOM/TCP header and appends checksum and ETX
+    """
+    payload = message + bytes(calc_checksum(message), 'utf-8') + ETX
+    return struct.pack('<HBxH', tid & 0xFFFF, PCOM_ASCII, len(payload)) + payload
+
+def command_code(message):
+    """
+    Command code of an ascii command, e.g. RNF for b'/00RNF000018'
+    """
+    code = b''
+    for c in message[3:]:
+        if not (65 <= c <= 90):
+            break
+        code = code + bytes([c])
+    return code.decode('ascii')
+
+def float_command(start, count):
+    return bytes('/00RNF%04X%02X' % (start, count), 'utf-8')
+
+def binary_checksum(data):
+    return (-sum(data)) & 0xFFFF
+
+def build_binary_frame(tid, command, data, unit=0, sub_command=bytes(6)):
+    """
+    Wraps a binary PCOM command and its data in the binary header and the PCOM/TCP header
+    """
+    header = BIN_STX + bytes([unit, 0xFE, 0x01, 0x00, 0x00, 0x00, command, 0x00]) + sub_command + \
+             struct.pack('<H', len(data))
+    payload = header + struct.pack('<H', binary_checksum(header)) + data + \
+              struct.pack('<H', binary_checksum(data)) + BIN_ETX
+    return struct.pack('<HBxH', tid & 0xFFFF, PCOM_BINARY, len(payload)) + payload
+
+def binary_float_command(start, count):
+    """
+    Binary read operands request for count MF registers from address start
+    """
+    return (BIN_READ_OPERANDS, struct.pack('<HBBH', count, OPERAND_MF | 0x80, 0xFF, start))
+
+def check_binary_reply(frame, tid):
+    """
+    Validates a binary PCOM reply and returns its data
+    """
+    if len(frame) < BIN_HEADER_LEN + 3 or not frame.startswith(BIN_STX) or not frame.endswith(BIN_ETX):
+        raise ShortFrameError("Binary frame %#06x is incomplete" % tid)
+    header = frame[:BIN_HEADER_LEN]
+    length, cs = struct.unpack('<HH', header[20:24])
+    if cs != binary_checksum(header[:22]):
+        raise ChecksumError("Header checksum mismatch in binary frame %#06x" % tid, tid)
+    data = frame[BIN_HEADER_LEN:BIN_HEADER_LEN + length]
+    if len(frame) != BIN_HEADER_LEN + length + 3:
+        raise ShortFrameError("Binary frame %#06x has the wrong length" % tid, tid)
+    if struct.unpack('<H', frame[-3:-1])[0] != binary_checksum(data):
+        raise ChecksumError("Data checksum mismatch in binary frame %#06x" % tid, tid)
+    return data
+
+def decode_floats(hex_data, dtype=float64):
+    """
+    Decodes the ascii hex payload of a RNF reply in one pass.
+    Every float is two 16 bit registers of 4 hex characters each, low word first,
+    so the words of each pair are swapped before reinterpreting them as big endian float32.
+    """
+    raw = bytes.fromhex(hex_data)
+    words = frombuffer(raw[:len(raw) - len(raw) % 4], dtype='>u2').reshape(-1, 2)
+    return words[:, ::-1].copy().view('>f4').ravel().astype(dtype)
+
+class RegisterSet:
+    """
+    The float registers a caller needs, given as {name: address} or a list of addresses.
+    The registers are read with the fewest RNF blocks: registers at most max_gap addresses
+    apart share a block because reading a few unused floats is cheaper than another request.
+    """
+
+    def __init__(self, registers, max_gap=16, max_block=MAX_RNF_COUNT):
+        if isinstance(registers, dict):
+            self.names = list(registers.keys())
+            self.addresses = [int(a) for a in registers.values()]
+        else:
+            self.addresses = [int(a) for a in registers]
+            self.names = list(self.addresses)
+        self.blocks = []
+        for a in sorted(set(self.addresses)):
+            if self.blocks != []:
+                start, count = self.blocks[-1]
+                if a - (start + count) <= max_gap and a - start < max_block:
+                    self.blocks[-1] = (start, a - start + 1)
+                    continue
+            self.blocks.append((a, 1))
+        # position of every register in the concatenated block values
+        offsets = {}
+        n = 0
+        for start, count in self.blocks:
+            offsets[start] = n
+            n = n + count
+        index = []
+        for a in self.addresses:
+            start = max(b for b, c in self.blocks if b <= a)
+            index.append(offsets[start] + a - start)
+        self.index = array(index, dtype=int)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def select(self, block_values):
+        """
+        Picks the requested registers out of the concatenated block values, in the order they were given
+        """
+        return block_values[self.index]
+
+    def as_dict(self, values):
+        return dict(zip(self.names, values))
+
+class DriverStats:
+    """
+    Round trip latency histogram per command and error counters of one connection.
+    Thread safe, snapshot() can be called from the GUI, the logger or the pcas server.
+    """
+    # upper bucket edges of the latency histogram in ms, the last bucket is open
+    BUCKETS_MS = [0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+    COUNTERS = ['timeouts', 'short_frames', 'checksum_errors', 'stale_frames',
+                'reconnects', 'connect_failures', 'link_down_reads']
+
+    def __init__(self,):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self,):
+        with self.lock:
+            self._reset()
+
+    def _reset(self,):
+        self.since = perf_counter()
+        self.commands = {}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def record(self, command, seconds):
+        ms = seconds*1e3
+        n = 0
+        while n < len(self.BUCKETS_MS) and ms > self.BUCKETS_MS[n]:
+            n = n + 1
+        with self.lock:
+            c = self.commands.setdefault(command, {'count': 0, 'sum_ms': 0.0, 'max_ms': 0.0,
+                                                   'histogram': [0]*(len(self.BUCKETS_MS) + 1)})
+            c['count'] += 1
+            c['sum_ms'] += ms
+            c['max_ms'] = max(c['max_ms'], ms)
+            c['histogram'][n] += 1
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def _percentile(self, c, q):
+        """
+        The q quantile interpolated within the bucket holding it, never above the max. The open
+        bucket ends at the max
+        """
+        rank = q*c['count']
+        total = 0
+        for n, k in enumerate(c['histogram']):
+            total = total + k
+            if total >= rank and k > 0:
+                lower = self.BUCKETS_MS[n - 1] if n > 0 else 0.0
+                upper = min(self.BUCKETS_MS[n] if n < len(self.BUCKETS_MS) else c['max_ms'], c['max_ms'])
+                return min(lower + (upper - lower)*(rank - (total - k))/k, c['max_ms'])
+        return NaN
+
+    def snapshot(self, reset=False):
+        """
+        Returns a copy of the counters and per command latency stats (ms), optionally starting over
+        """
+        with self.lock:
+            snap = dict(self.counters)
+            snap['seconds'] = perf_counter() - self.since
+            snap['commands'] = {}
+            for command, c in self.commands.items():
+                snap['commands'][command] = {'count': c['count'],
+                                             'mean_ms': c['sum_ms']/c['count'],
+                                             'p50_ms': self._percentile(c, 0.5),
+                                             'p99_ms': self._percentile(c, 0.99),
+                                             'max_ms': c['max_ms'],
+                                             'histogram': list(c['histogram'])}
+            # in the same locked section so nothing recorded after the copy is lost
+            if reset:
+                self._reset()
+        snap['errors'] = snap['timeouts'] + snap['short_frames'] + snap['checksum_errors'] + snap['connect_failures']
+        return snap
+
+class PcomFrameReader:
+    """
+    Receive buffer that reassembles PCOM/TCP replies from the byte stream.
+    Replies may be split across or packed into TCP segments, the header length
+    tells us where a frame ends.
+    """
+
+    def __init__(self,):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf.extend(data)
+
+    def clear(self,):
+        self.buf.clear()
+
+    def next_frame(self,):
+        """
+        Returns (transaction id, message) for the next complete frame in the buffer
+        or None if more data is needed. message is the reply without checksum and ETX,
+        for binary replies only the data.
+        """
+        if len(self.buf) < HEADER_LEN:
+            return None
+        tid, protocol, length = struct.unpack('<HBxH', self.buf[:HEADER_LEN])
+        if len(self.buf) < HEADER_LEN + length:
+            return None
+        frame = bytes(self.buf[HEADER_LEN:HEADER_LEN + length])
+        del self.buf[:HEADER_LEN + length]
+        if protocol == PCOM_BINARY:
+            return tid, check_binary_reply(frame, tid)
+        if not frame.endswith(ETX):
+            # we lost track of the frame boundaries, nothing left in the buffer can be trusted
+            self.clear()
+            raise ShortFrameError("Frame %#06x is missing the ETX" % tid)
+        message, cs = frame[:-3], frame[-3:-1]
+        if cs.upper() != bytes(calc_checksum(message, skip=2), 'utf-8'):
+            raise ChecksumError("Checksum mismatch in frame %#06x" % tid, tid)
+        return tid, message
+
 class Vision130Driver:
+    """
+    Synchronous PCOM/TCP driver. The connection is looked after by a supervisor thread that
+    reconnects in the background with exponential backoff, while the link is down all reads
+    return NaN right away so the caller never waits on a connect.
+    """
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, timeout=1.0, min_backoff=0.5, max_backoff=30.0, mode='ascii'):
+        """
+        mode selects the PCOM dialect used for float reads: 'ascii' or 'binary'
+        """
+        if mode not in ('ascii', 'binary'):
+            raise ValueError("mode must be 'ascii' or 'binary'")
         self.host = host
         self.port = port
-        self._connect()
+        self.mode = mode
+        self.max_block = MAX_BINARY_COUNT if mode == 'binary' else MAX_RNF_COUNT
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.reader = PcomFrameReader()
+        self.stats = DriverStats()
+        self.tid = 0
+        self.s = None
+        self.connected = False
+        self.connected_once = False
+        self.eol = b'\r'
+        # serializes requests and socket swaps between the caller and the supervisor
+        self.lock = threading.Lock()
+        self._link_down = threading.Event()
+        self._link_down.set()
+        self._closed = threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise, name='Vision130-' + str(host), daemon=True)
+        self._supervisor.start()
+
+    def _supervise(self,):
+        """
+        Reconnects whenever the link is reported down, backing off exponentially with jitter
+        """
+        backoff = self.min_backoff
+        while not self._closed.is_set():
+            self._link_down.wait()
+            if self._closed.is_set():
+                break
+            if self._connect():
+                backoff = self.min_backoff
+            else:
+                # full jitter keeps several monitors from hammering a rebooting PLC in lockstep
+                self._closed.wait(uniform(0, backoff))
+                backoff = min(backoff*2, self.max_backoff)
 
     def _connect(self,):
         try:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.s.settimeout(1)
-            print ("Socket successfully created")
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # notice a dead link after ~10 s of silence instead of the 2 h OS default
+            if hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+                s.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 10000, 3000))
+            elif hasattr(socket, 'TCP_KEEPIDLE'):
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 3)
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
         except Exception as err:
             print ("socket creation failed with error %s" %(err))
-        self.eol = b'\r'
+            return False
         try:
-            self.s.connect((self.host, int(self.port)))
+            s.connect((self.host, int(self.port)))
         except Exception as e:
-            self.s.close()
+            s.close()
+            self.stats.count('connect_failures')
             print ("Could not connect with socket-server (host/port error): %s" % e)
-        except socket.error as e:
-            self.s.close()
-            print ("Connection error: %s" % e)
+            return False
+        with self.lock:
+            # close_comm() was called while connecting, its _mark_down() has run already
+            if self._closed.is_set():
+                s.close()
+                return False
+            if self.connected_once:
+                self.stats.count('reconnects')
+            self.connected_once = True
+            self.s = s
+            # replies still in flight on the old connection are of no use anymore
+            self.reader.clear()
+            # cleared before the link is up so a read failing right after is not lost
+            self._link_down.clear()
+            self.connected = True
+        print ("Socket successfully created")
+        return True
+
+    def _mark_down(self,):
+        """
+        Drops the connection and hands reconnecting over to the supervisor
+        """
+        with self.lock:
+            self.connected = False
+            if self.s is not None:
+                try:
+                    self.s.close()
+                except Exception as err:
+                    print (str(err))
+            self.s = None
+            if not self._closed.is_set():
+                self._link_down.set()
+
+    def _next_tid(self,):
+        self.tid = (self.tid + 1) & 0xFFFF
+        return self.tid
+
+    def _commands(self, messages):
+        with self.lock:
+            if not self.connected:
+                raise PcomError("Link to %s:%s is down" % (self.host, self.port))
+            return self._transact(messages)
+
+    def _command(self, message):
+        return self._commands([message])[0]
 
     def get_id(self,):
-        header= [0xd7, 0x73, 0x65, 0x00, 0x08, 0x00]
-        header = bytes(header)
-        message = b'/00ID' # Get ID
-        cs = self._calc_checksum(message)
-        data = self._socket_comm(header + message + bytes(cs, 'utf-8') + self.eol)
+        data = self._command(b'/00ID') # Get ID
+        return data.split('ID', 1)[-1]
     
     def get_time(self,):
-        header= [0xd8, 0x73, 0x65, 0x00, 0x08, 0x00]
-        header = bytes(header)
-        message = b'/00RC'
-        cs = self._calc_checksum(message)
-        data = self._socket_comm(header + message + bytes(cs, 'utf-8') + self.eol)
+        data = self._command(b'/00RC')
+        return data.split('RC', 1)[-1]
 
-    def get_all_float(self,):
+    def _read_blocks(self, blocks):
+        """
+        Reads the (start, count) float blocks in one go, returns one array per block
+        """
+        if self.mode == 'binary':
+            replies = self._commands([binary_float_command(start, count) for start, count in blocks])
+            values = [frombuffer(data, dtype='<f4').astype(float64) for data in replies]
+        else:
+            replies = self._commands([float_command(start, count) for start, count in blocks])
+            values = [decode_floats(data.split('RN')[1]) for data in replies]
+        for (start, count), ff in zip(blocks, values):
+            if len(ff) != count:
+                self.stats.count('short_frames')
+                raise PcomError("Expected %d floats, got %d" % (count, len(ff)))
+        return values
+
+    def get_all_float(self, start=0, count=24):
+        """
+        Reads count float registers starting at address start, returns a numpy array
+        Larger reads are split into blocks the selected PCOM dialect can carry.
+        NaN is returned immediately while the link is down
+        """
+        if not self.connected:
+            self.stats.count('link_down_reads')
+            return full(count, NaN)
         try:
-            header= [0xd6, 0x73, 0x65, 0x00, 0x08, 0x00]
-            header = bytes(header)
-            message = b'/00RNF000018'
-            cs = self._calc_checksum(message)
-            data = self._socket_comm(header + message + bytes(cs, 'utf-8') + self.eol)
-            
-            all_my_data = data.split('RN')
-            my_input = all_my_data[1]
-            # print(len(my_input))
-            dd = []
-            for i in range(0, len(my_input), 4):
-                dd.append(my_input[i:i+4])
-            # print (dd)
-            dd.pop(-1)
-            ee = []
-            for i, j in zip(dd[0::2], dd[1::2]):
-                ee.append(j+i) 
-            ff = []
-            for i in ee:
-                ff.append(struct.unpack('!f', bytes.fromhex(i))[0])
+            blocks = [(a, min(self.max_block, start + count - a)) for a in range(start, start + count, self.max_block)]
+            ff = concatenate(self._read_blocks(blocks))
             return(ff)
         except:
-            # try to reconnect
-            self.close_comm()
-            self._connect()
-            return [NaN]*24
+            # let the supervisor reconnect
+            self._mark_down()
+            return full(count, NaN)
+
+    def read_registers(self, regset):
+        """
+        Reads only the blocks planned by the RegisterSet, returns the values in the order of its registers
+        """
+        if not self.connected:
+            self.stats.count('link_down_reads')
+            return full(len(regset), NaN)
+        try:
+            return regset.select(concatenate(self._read_blocks(regset.blocks)))
+        except:
+            # let the supervisor reconnect
+            self._mark_down()
+            return full(len(regset), NaN)
 
     def _calc_checksum(self, message):
-        msg_list = [*message]
-        mysum = 0
-        for i in (msg_list[1:]):
-            mysum = mysum + i
-        return hex(mysum % 256)[2:].upper()    
+        return calc_checksum(message)
     
-    def _socket_comm(self, command):
-        self.s.send(command)
-        data = self.s.recv(1024)
-        all_data = str(data.decode('unicode_escape'))
-        return (all_data)
+    def _transact(self, messages):
+        """
+        Sends all commands back to back and returns their validated replies in the same order.
+        Replies are matched to the commands by transaction id.
+        Ascii commands are bytes and return str, binary commands are (command, data) and return bytes.
+        """
+        tids = {}
+        out = b''
+        for message in messages:
+            tid = self._next_tid()
+            if isinstance(message, tuple):
+                tids[tid] = 'BIN%02X' % message[0]
+                out = out + build_binary_frame(tid, *message)
+            else:
+                tids[tid] = command_code(message)
+                out = out + build_frame(tid, message)
+        replies = {}
+        try:
+            start = perf_counter()
+            self.s.sendall(out)
+            while len(replies) < len(tids):
+                frame = self.reader.next_frame()
+                if frame is None:
+                    data = self.s.recv(1024)
+                    if not data:
+                        raise ShortFrameError("Connection closed by the PLC")
+                    self.reader.feed(data)
+                    continue
+                reply_tid, message = frame
+                # late replies to earlier requests that timed out are dropped
+                if reply_tid in tids:
+                    if tids[reply_tid].startswith('BIN'):
+                        replies[reply_tid] = message
+                    else:
+                        replies[reply_tid] = str(message.decode('ascii'))
+                    self.stats.record(tids[reply_tid], perf_counter() - start)
+                else:
+                    self.stats.count('stale_frames')
+        except socket.timeout:
+            self.stats.count('timeouts')
+            raise
+        except ChecksumError:
+            self.stats.count('checksum_errors')
+            raise
+        except ShortFrameError:
+            self.stats.count('short_frames')
+            raise
+        return [replies[tid] for tid in tids]
     
     def close_comm(self,):
+        """
+        Stops the supervisor and closes the connection for good
+        """
+        self._closed.set()
+        self._link_down.set()
+        self._mark_down()
+
+class Vision130:
+    """
+    asyncio client for the Vision 130. Every request gets its own transaction id so
+    several requests can be in flight on one connection, replies are matched by that id.
+    A single event loop can serve several controllers, one client per controller.
+    """
+
+    def __init__(self, host, port, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.tid = 0
+        self._pending = {}
+        self._writer = None
+        self._rx_task = None
+
+    async def connect(self,):
+        reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, int(self.port)), self.timeout)
+        self._rx_task = asyncio.ensure_future(self._receive(reader))
+
+    async def _receive(self, reader):
+        """
+        Dispatches incoming frames to the requests waiting for them
+        """
+        frames = PcomFrameReader()
         try:
-            self.s.close()
-        except Exception as err:
-            print (str(err))
-            pass
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    raise PcomError("Connection closed by the PLC")
+                frames.feed(data)
+                while True:
+                    try:
+                        frame = frames.next_frame()
+                    except PcomError as e:
+                        if e.tid is None:
+                            raise
+                        self._resolve(e.tid, exc=e)
+                        continue
+                    if frame is None:
+                        break
+                    self._resolve(*frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            self._pending.clear()
+
+    def _resolve(self, tid, message=None, exc=None):
+        fut = self._pending.pop(tid, None)
+        # nobody waits for replies of requests that already timed out
+        if fut is None or fut.done():
+            return
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(message.decode('ascii'))
+
+    def _next_tid(self,):
+        self.tid = (self.tid + 1) & 0xFFFF
+        while self.tid in self._pending:
+            self.tid = (self.tid + 1) & 0xFFFF
+        return self.tid
+
+    async def request(self, message):
+        """
+        Sends an ascii command and waits for its reply, returns the reply without checksum and ETX
+        """
+        if self._writer is None or self._rx_task is None or self._rx_task.done():
+            raise PcomError("Not connected")
+        tid = self._next_tid()
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[tid] = fut
+        try:
+            self._writer.write(build_frame(tid, message))
+            return await asyncio.wait_for(fut, self.timeout)
+        finally:
+            self._pending.pop(tid, None)
+
+    async def read_floats(self, start, count):
+        data = await self.request(float_command(start, count))
+        ff = decode_floats(data.split('RN')[1])
+        if len(ff) != count:
+            raise PcomError("Expected %d floats, got %d" % (count, len(ff)))
+        return ff
+
+    async def get_id(self,):
+        data = await self.request(b'/00ID')
+        return data.split('ID', 1)[-1]
+
+    async def get_time(self,):
+        data = await self.request(b'/00RC')
+        return data.split('RC', 1)[-1]
+
+    async def poll(self, start=0, count=24):
+        """
+        Pipelines the float block and the PLC time, costs roughly one round trip
+        """
+        return await asyncio.gather(self.read_floats(start, count), self.get_time())
+
+    async def close(self,):
+        if self._rx_task is not None:
+            self._rx_task.cancel()
+            try:
+                await self._rx_task
+            except asyncio.CancelledError:
+                pass
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception as err:
+                print (str(err))
+        self._writer = None
+        self._rx_task = None
 
 if __name__ == '__main__':
     print("I am main!")
\ No newline at end of file
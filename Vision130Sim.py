@@ -0,0 +1,254 @@
+#! /usr/bin/env python
+"""
+Stand-alone simulator of the Vision 130 PCOM/TCP interface, standard library only.
+Answers /00ID, /00RC and /00RNF as well as binary read operand requests for MF registers
+with correct headers and checksums so the driver can be
+exercised and benchmarked without the PLC. Latency, fragmented replies, dropped
+connections and corrupt replies can be injected.
+
+    python Vision130Sim.py -p 20256 --latency 5 --fragment 7 --drop 0.01
+"""
+
+import socketserver
+import struct
+import threading
+from argparse import ArgumentParser
+from datetime import datetime
+from math import sin, pi
+from random import random, gauss
+from time import sleep, time
+
+HEADER_LEN = 6
+PCOM_ASCII = 0x65
+PCOM_BINARY = 0x66
+ETX = b'\r'
+BIN_STX = b'/_OPLC'
+BIN_ETX = b'\\'
+BIN_HEADER_LEN = 24
+BIN_READ_OPERANDS = 0x4D
+OPERAND_MF = 0x07
+PLC_ID = 'V130-33-T38'
+# registers of the bpc with their base value and amplitude
+BPC_WAVEFORMS = {20: (25.0, 0.5),   # pressure [mbar]
+                 10: (2.5, 1.5),    # He flow [l/min]
+                 23: (50.0, 40.0)}  # valve [%]
+
+def calc_checksum(message, skip=1):
+    return '%02X' % (sum(message[skip:]) % 256)
+
+def binary_checksum(data):
+    return (-sum(data)) & 0xFFFF
+
+def encode_floats(values):
+    """
+    Ascii hex of float registers as the PLC sends them, low word first
+    """
+    out = []
+    for v in values:
+        h = struct.pack('!f', v).hex().upper()
+        out.append(h[4:] + h[:4])
+    return ''.join(out)
+
+class Registers:
+    """
+    Float registers following a waveform with the given period in seconds
+    """
+
+    def __init__(self, waveform='sine', period=60.0, noise=0.0):
+        self.waveform = waveform
+        self.period = period
+        self.noise = noise
+        self.t0 = time()
+
+    def value(self, address, t):
+        base, amplitude = BPC_WAVEFORMS.get(address, (float(address), 1.0))
+        phase = ((t - self.t0) / self.period + address / 24.0) % 1.0
+        if self.waveform == 'const':
+            v = base
+        elif self.waveform == 'ramp':
+            v = base + amplitude * (2 * phase - 1)
+        elif self.waveform == 'noise':
+            v = base + amplitude * (2 * random() - 1)
+        else:
+            v = base + amplitude * sin(2 * pi * phase)
+        if self.noise > 0:
+            v = v + gauss(0, self.noise)
+        return v
+
+    def read(self, start, count):
+        t = time()
+        return [self.value(a, t) for a in range(start, start + count)]
+
+class PcomHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one client connection
+    """
+
+    def handle(self,):
+        opts = self.server.opts
+        buf = b''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            buf = buf + data
+            while len(buf) >= HEADER_LEN:
+                tid, protocol, length = struct.unpack('<HBxH', buf[:HEADER_LEN])
+                if protocol == PCOM_BINARY:
+                    if len(buf) < HEADER_LEN + length:
+                        break
+                    frame = buf[HEADER_LEN:HEADER_LEN + length]
+                    buf = buf[HEADER_LEN + length:]
+                    self.server.stats['requests'] += 1
+                    reply = self.binary_reply(frame)
+                else:
+                    end = buf.find(ETX, HEADER_LEN)
+                    if end < 0:
+                        break
+                    # the ETX ends the command, the header length is not trusted
+                    message = buf[HEADER_LEN:end - 2]
+                    cs = buf[end - 2:end]
+                    buf = buf[end + 1:]
+                    self.server.stats['requests'] += 1
+                    if cs.upper() != bytes(calc_checksum(message), 'utf-8'):
+                        self.server.stats['bad_checksum'] += 1
+                        continue
+                    reply = self.reply(message)
+                if opts.drop > 0 and random() < opts.drop:
+                    self.server.stats['dropped'] += 1
+                    self.request.close()
+                    return
+                if reply is None:
+                    continue
+                if opts.latency > 0 or opts.jitter > 0:
+                    sleep(max(0.0, opts.latency + gauss(0, opts.jitter)) * 1e-3)
+                if protocol == PCOM_BINARY:
+                    self.send_binary(tid, *reply)
+                else:
+                    self.send(tid, reply)
+
+    def reply(self, message):
+        text = message.decode('ascii', 'replace')
+        unit, cmd = text[1:3], text[3:]
+        if cmd.startswith('ID'):
+            body = 'ID' + PLC_ID
+        elif cmd.startswith('RC'):
+            now = datetime.now()
+            body = 'RC' + now.strftime('%S%M%H') + '%02d' % (now.isoweekday() % 7 + 1) + now.strftime('%d%m%y')
+        elif cmd.startswith('RNF'):
+            start, count = int(cmd[3:7], 16), int(cmd[7:9], 16)
+            body = 'RN' + encode_floats(self.server.registers.read(start, count))
+        else:
+            self.server.stats['unknown'] += 1
+            return None
+        return bytes('/A' + unit + body, 'utf-8')
+
+    def binary_reply(self, frame):
+        """
+        Returns (header, data) of the reply to a binary read operands request for MF registers
+        """
+        if len(frame) < BIN_HEADER_LEN + 3 or not frame.startswith(BIN_STX) or not frame.endswith(BIN_ETX):
+            self.server.stats['bad_checksum'] += 1
+            return None
+        header = frame[:BIN_HEADER_LEN]
+        length, cs = struct.unpack('<HH', header[20:24])
+        data = frame[BIN_HEADER_LEN:BIN_HEADER_LEN + length]
+        if cs != binary_checksum(header[:22]) or struct.unpack('<H', frame[-3:-1])[0] != binary_checksum(data):
+            self.server.stats['bad_checksum'] += 1
+            return None
+        if header[12] != BIN_READ_OPERANDS:
+            self.server.stats['unknown'] += 1
+            return None
+        values = []
+        for i in range(0, len(data) - 5, 6):
+            count, operand, reserved, start = struct.unpack('<HBBH', data[i:i + 6])
+            if operand != OPERAND_MF | 0x80:
+                self.server.stats['unknown'] += 1
+                return None
+            values.extend(self.server.registers.read(start, count))
+        reply_header = header[:12] + bytes([header[12] | 0x80]) + header[13:20]
+        return reply_header, struct.pack('<%df' % len(values), *values)
+
+    def send_binary(self, tid, header, data):
+        header = header + struct.pack('<H', len(data))
+        cs = binary_checksum(data)
+        if self.server.opts.corrupt > 0 and random() < self.server.opts.corrupt:
+            cs = (cs + 1) & 0xFFFF
+            self.server.stats['corrupted'] += 1
+        payload = header + struct.pack('<H', binary_checksum(header)) + data + struct.pack('<H', cs) + BIN_ETX
+        self.write(struct.pack('<HBxH', tid, PCOM_BINARY, len(payload)) + payload)
+
+    def send(self, tid, message):
+        opts = self.server.opts
+        cs = calc_checksum(message, skip=2)
+        if opts.corrupt > 0 and random() < opts.corrupt:
+            cs = '%02X' % ((int(cs, 16) + 1) % 256)
+            self.server.stats['corrupted'] += 1
+        payload = message + bytes(cs, 'utf-8') + ETX
+        self.write(struct.pack('<HBxH', tid, PCOM_ASCII, len(payload)) + payload)
+
+    def write(self, frame):
+        opts = self.server.opts
+        try:
+            if opts.fragment > 0:
+                for i in range(0, len(frame), opts.fragment):
+                    self.request.sendall(frame[i:i + opts.fragment])
+                    sleep(opts.fragment_delay * 1e-3)
+            else:
+                self.request.sendall(frame)
+        except OSError:
+            return
+        self.server.stats['replies'] += 1
+
+class Vision130Sim(socketserver.ThreadingTCPServer):
+    """
+    One simulated controller listening on host:port
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host, port, opts):
+        self.opts = opts
+        self.registers = Registers(opts.waveform, opts.period, opts.noise)
+        self.stats = dict.fromkeys(['requests', 'replies', 'bad_checksum', 'unknown', 'dropped', 'corrupted'], 0)
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), PcomHandler)
+
+def sim_parser():
+    parser = ArgumentParser(prog='Vision130Sim',
+                            description='Simulate the PCOM/TCP interface of one or more Vision 130 PLCs.')
+    parser.add_argument('-i', '--host', help='address to listen on', default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='first port to listen on', default=20256, type=int)
+    parser.add_argument('-n', '--count', help='number of simulated controllers on consecutive ports', default=1, type=int)
+    parser.add_argument('--latency', help='reply latency in ms', default=0.0, type=float)
+    parser.add_argument('--jitter', help='standard deviation of the reply latency in ms', default=0.0, type=float)
+    parser.add_argument('--fragment', help='send replies in segments of this many bytes, 0 sends whole frames', default=0, type=int)
+    parser.add_argument('--fragment_delay', help='delay between fragments in ms', default=1.0, type=float)
+    parser.add_argument('--drop', help='probability to drop the connection instead of replying', default=0.0, type=float)
+    parser.add_argument('--corrupt', help='probability to send a reply with a wrong checksum', default=0.0, type=float)
+    parser.add_argument('--waveform', help='register waveform', default='sine', choices=['sine', 'ramp', 'noise', 'const'])
+    parser.add_argument('--period', help='waveform period in s', default=60.0, type=float)
+    parser.add_argument('--noise', help='gaussian noise added to every register', default=0.0, type=float)
+    parser.add_argument('--stats', help='print request statistics every n seconds, 0 disables', default=10.0, type=float)
+    return parser
+
+if __name__ == '__main__':
+    opts = sim_parser().parse_args()
+    servers = []
+    for n in range(opts.count):
+        server = Vision130Sim(opts.host, opts.port + n, opts)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        print ("Simulated Vision 130 listening on %s:%d" % (opts.host, opts.port + n))
+    try:
+        while True:
+            sleep(opts.stats if opts.stats > 0 else 1.0)
+            if opts.stats > 0:
+                for server in servers:
+                    print ("%s:%d %s" % (server.server_address[0], server.server_address[1], server.stats))
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
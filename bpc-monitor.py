@@ -1,8 +1,17 @@
 # -*- coding: utf-8 -*-
 # Note: For the CCC dewars: 1 inch of lHe is 1 Ltr of lHe
-import sys, functools
-from os import environ, chdir, sep, path, mkdir, getcwd, scandir
-from argparse import ArgumentParser, ArgumentTypeError
+import sys
+from os import environ, chdir, sep, getcwd, scandir, path, cpu_count
+from multiprocessing import freeze_support
+
+if __name__ == '__main__':
+    # the history worker processes of the frozen executable start here
+    freeze_support()
+
+if __name__ == '__main__' and '--headless' in sys.argv[1:]:
+    # run as a service without loading Qt, matplotlib and pandas
+    import bpc_core
+    sys.exit(bpc_core.main())
 
 try:
     environ["QT_API"] = "pyqt6"
@@ -30,11 +39,17 @@ except ImportError:
 import pyqtgraph as pg
 from collections import deque
 from datetime import datetime, timedelta
-from time import strftime, time, perf_counter, sleep
+from time import time, perf_counter
 import inspect, signal
 # controller class
 import Vision130
-from numpy import NaN, mean, array, Inf, isnan, float64, int64, asarray
+# acquisition, data files, pcas server and email alerts
+from bpc_core import Poller, pvdb, arg_parser, make_controllers, start_logging, start_pcas, start_writer
+import bpc_core
+import bpc_store
+# parsing of the history files in worker processes
+from bpc_history import read_files, configure_cache, CACHE
+from numpy import mean, array, Inf, isnan, float64, int64, asarray
 # matplotlib imports
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
@@ -42,20 +57,15 @@ import matplotlib
 from matplotlib.dates import ConciseDateFormatter, AutoDateLocator
 import matplotlib.style as mplstyle
 import matplotlib.pyplot as plt
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock, Thread
 
-from pandas import read_csv, concat, to_datetime, set_option
+from pandas import concat, to_datetime, set_option, DataFrame
+from pandas.tseries.frequencies import to_offset
 
-from pcaspy import SimpleServer, Driver
 from pcaspy.tools import ServerThread
 # for logging
 import logging
-from logging.handlers import TimedRotatingFileHandler
-
-from smtplib import SMTP
-from email.mime.text import MIMEText
-
-from random import uniform, random
 
 # base directory of the project
 if getattr(sys, 'frozen', False):
@@ -86,19 +96,21 @@ logger.setLevel(logging.INFO)
 # if num_processes < 3: ctypes.WinDLL('user32').ShowWindow(kernel32.GetConsoleWindow(), 0)
 # python globals
 __version__ = '2.4.3' # Program version string
-MAIN_THREAD_POLL = 1000 # in ms (1 s)
-# EMAIL_POLL = 300000 # for testing
-EMAIL_POLL = 1.44e7 # in ms (4 hours)
+MAIN_THREAD_POLL = bpc_core.MAIN_THREAD_POLL # in ms, sampling period of the controllers
 #He_EXP_RATIO = 1./754.2 # liquid to gas expansion ratio for Helium at 1 atm and 70 F
 WIDTH = 480
 HEIGHT= 460
 HIST = 24
-WORKERS = 8
-START_LHE = ''
-THRESHOLD_LHE = ''
-START_LHE_CHANGED = 0
-# globals
-df_bpcCtrl =     None
+# history worker processes, one core is left to the acquisition
+WORKERS = max(1, (cpu_count() or 2) - 1)
+# re-plot period of the history in follow mode in ms
+FOLLOW_POLL = 5000
+# process pool parsing the history files, shared by all queries
+POOL = None
+POOL_LOCK = Lock()
+# plot durations in s, read from the binary log
+DURATIONS = {'365 days': 3.1536*1e7, '180 days': 1.5552*1e7, '90 days': 7.776*1e6, '30 days': 2.592*1e6, \
+             '14 days': 1.2096*1e6, '7 days': 604800, '2 days': 172800}
 
 chdir(base_dir)
 # load the main ui file
@@ -146,33 +158,8 @@ style = """QTabWidget::tab-bar{
            alignment: right;
            }"""
 
-pvdb = {
-        'PRESSURE':         {'prec'  : 3,
-                             'unit'  : 'mbar',
-                             'scan'  : 1},
-        'LHE_RECOVERED':    {'prec'  : 6,
-                             'unit'  : 'l/day',
-                             'scan'  : 1},
-        'VALVE':            {'prec'  : 0,
-                             'unit'  : '%',
-                             'scan'  : 1},
-        'HE_FLOW':          {'prec'  : 6,
-                             'unit'  : 'l/min',
-                             'scan'  : 1},
-        'LHE_LEFT':         {'prec'  : 3,
-                             'unit'  : 'l',
-                             'scan'  : 1},
-        'LHE_FIN':          {'prec'  : 2,
-                             'unit'  : 'day',
-                             'scan'  : 1},
-        }
 set_option('float_format', '{:f}'.format)
 
-class myDriver(Driver):
-
-    def __init__(self):
-       super(myDriver,self).__init__()
-
 class MplCanvas(FigureCanvasQTAgg):
 
     def __init__(self, parent=None, width=5, height=2, dpi=180):
@@ -193,27 +180,21 @@ class MplCanvas(FigureCanvasQTAgg):
         # self.fig.tight_layout(pad=0.4, w_pad=1, h_pad=1.0)
 
 class mainThread(QThread, QObject):
-    # define the signals that this thread calls
-    update_data = pyqtSignal(list)
-    plot_temp = pyqtSignal()
-    lHe_est_time_to_threshold = pyqtSignal(float)
-    remaining_lHe_signal = pyqtSignal(float)
-    rec_signal = pyqtSignal(float)
-
-    def __init__(self):
+    # one bpc_core.Sample per controller and cycle
+    sample_signal = pyqtSignal(object)
+
+    def __init__(self, poller):
         """
-        Constructor for the main thread
+        Constructor for the main thread, it runs the polling loop of the core
+        and forwards every sample to the windows
         """
         #logger.info("In function: " + inspect.stack()[0][3])
         QtCore.QThread.__init__(self)
         QtCore.QObject.__init__(self)
         self.setTerminationEnabled(True)
-        self.integrated_lHe_used = 0.0
-        self.remaining_lHe = NaN
-        self.calc_time_to_threshold = Inf
-        self._kill = False
-        self.loop_time = 0
-        self.rec = []
+        self.poller = poller
+        self.controllers = poller.controllers
+        self.poller.on_sample = self.sample_signal.emit
 
     def __del__(self):
         """
@@ -222,208 +203,328 @@ class mainThread(QThread, QObject):
         self.wait()
         #logger.info("In function: " + inspect.stack()[0][3])
 
-    def _getRbvs(self,):
-        #logger.info("In function: " + inspect.stack()[0][3])
-        if debug_mode:
-            debug_bpc_rbv = [random() for i in range(24)]
-            debug_bpc_rbv[20] = uniform(24.5, 25.5)
-            debug_bpc_rbv[-1] = uniform(0,100)
-            debug_bpc_rbv[10] = uniform (0, 5)
-            return debug_bpc_rbv
-        else:
-            try:
-                bpc_rbv =  mybpc.get_all_float() # get all float data from the controller
-                return bpc_rbv
-            except Exception as e:
-                logger.info("In function: " + inspect.stack()[0][3] + ' ' + str(e))
-                return [NaN]*24
-
     def run(self):
         """
-        Main thread processing loop
-        - emits various signals to update or poll data from devices
-        - This function is called every 1 s, this can be changed by setting
-          MAIN_THREAD_POLL
+        Main thread processing loop, see bpc_core.Poller.run
         """
-        global MAIN_THREAD_POLL
-        global START_LHE
-        global THRESHOLD_LHE
-        global START_LHE_CHANGED
-        while 1 and not self._kill:
-            try:
-                #logger.info("In function: " + inspect.stack()[0][3])
-                start_time = perf_counter()
-                all_rbv = self._getRbvs()
-                if not (isnan(all_rbv[10])):
-                    recovered = (correction*all_rbv[10])*60*24/(expansion_ratio)
-                    self.rec.append(recovered)
-                else:
-                    recovered = NaN
-                # all_rbv.insert(len(all_rbv), recovered)
-                # if user enters lHe start ltrs...
-                if START_LHE != '':
-                    # get the starting lHe from user
-                    start_lHe = float(START_LHE)
-                    if start_lHe > 0:
-                        if not (isnan(recovered)):
-                            try:
-                                if START_LHE_CHANGED:
-                                    self.integrated_lHe_used = 0
-                                    START_LHE_CHANGED = 0
-                                # instantaneous lHe being used in litres/sec
-                                inst_lHe_used = (recovered/86400.0)*self.loop_time
-                                # integrated lHe being used in liters
-                                if not isnan(inst_lHe_used):
-                                    self.integrated_lHe_used = self.integrated_lHe_used + inst_lHe_used
-                                # remaining lHe in dewar in percent
-                                # remaining_lHe_perc = 100.0 - (self.integrated_lHe_used/start_lHe)*100.0
-                                # remaining_lHe used in litres
-                                    self.remaining_lHe = round((start_lHe - self.integrated_lHe_used), 4)
-                                # print ("Integrated: ", self.integrated_lHe_used, "Remaining %:", remaining_lHe_perc)
-                                if float(self.remaining_lHe) <= 0:
-                                    self.remaining_lHe = 0
-                            except Exception as e:
-                                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
-                                pass
-                            if THRESHOLD_LHE != '' and float(THRESHOLD_LHE) < start_lHe and mean(self.rec) != 0:
-                                start_lHe_threshold_corr = start_lHe - float(THRESHOLD_LHE)
-                                self.calc_time_to_threshold = round(((start_lHe_threshold_corr - self.integrated_lHe_used)/mean(self.rec)), 2)
-
-                                #     main_window.lbl_lHe_per_remain_rbv.setStyleSheet("color: red; background-color: black;")
-                                # else:
-                                #     main_window.lbl_lHe_per_remain_rbv.setStyleSheet("color: rgb(0, 170, 0); background-color: black;")
-                            else:
-                                self.calc_time_to_threshold = Inf
-                    else:
-                        # start lHe <=0
-                        self.remaining_lHe = NaN
-                        self.calc_time_to_threshold = Inf
-                        self.integrated_lHe_used = 0
-                else:
-                    # if start ltr text == ''
-                    self.remaining_lHe = NaN
-                    self.calc_time_to_threshold = Inf
-                    self.integrated_lHe_used = 0
-                self.update_data.emit(all_rbv)
-                self.lHe_est_time_to_threshold.emit(self.calc_time_to_threshold)
-                self.rec_signal.emit(recovered)
-                self.remaining_lHe_signal.emit(self.remaining_lHe)
-                self.plot_temp.emit()
-                #print ("Time taken to execute: ", perf_counter() - start_time )
-                if len(self.rec) > 60:
-                    self.rec.pop(0)
-            except Exception as e:
-                self.update_data.emit(all_rbv)
-                self.lHe_est_time_to_threshold.emit(self.calc_time_to_threshold)
-                self.rec_signal.emit(recovered)
-                self.remaining_lHe_signal.emit(NaN)
-                # emit this signal last
-                self.plot_temp.emit()
-                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
-                pass
-            if debug_log_flag:
-                logger.info("Remaining lHe: " + str(self.remaining_lHe))
-            sleep(MAIN_THREAD_POLL*0.001)
-            # # makes sure that the GUI thread gets processed
-            # app.processEvents()
-            self.loop_time = perf_counter() - start_time
+        self.poller.run()
 
     def stop(self):
         """
         Stops the main thread gracefully
         """
-        self._kill = True
+        self.poller.stop()
         self.quit()
         self.wait()
 
+def warm_cache(dirpath, days):
+    """
+    Parses the past days into the cache in the background so the first plots find them
+    """
+    try:
+        now = datetime.now()
+        filenames = [bpc_store.txt_name(dirpath, now - timedelta(days=n)) for n in range(days, 0, -1)]
+        read_files([f for f in filenames if bpc_store.day_file(f) is not None], history_pool())
+        logger.info("Warmed the history cache of " + str(dirpath) + ": " + str(CACHE.snapshot()))
+    except Exception as e:
+        logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+
+def history_pool():
+    """
+    Returns the process pool parsing the history files, it is started by the first query
+    """
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ProcessPoolExecutor(max_workers=WORKERS)
+        return POOL
+
 class WorkerSignals(QObject):
-    # job completed signal
-    mysignalfin = pyqtSignal()
+    # job completed signal, carries the resampled dataframe or None
+    mysignalfin = pyqtSignal(object)
 
 class Worker(QRunnable):
-    def __init__(self, dirpath, duration, caller, start, end):
+    def __init__(self, dirpath, duration, caller, start, end, binsize, previous=None):
        super(Worker, self).__init__()
        self.signals = WorkerSignals()
        self.dirpath = dirpath
+       self.binsize = binsize
        self.filename = None
        self.headers = ['Date', 'Pressure', 'Flow', 'Valve']
        self.duration = duration
        self.start = start
        self.end = end
        self.caller = caller
+       # the last plot of the same duration and binning, only its tail is binned again
+       self.previous = previous
 
-    def _read_helper(self, filename,):
+    def _read_helper(self, filenames,):
+        """
+        helper function for get_data, parses the files in the process pool and returns their
+        data in date order
+        """
+        if filenames == []:
+            return []
+        filenames = sorted(filenames, key=path.basename)
+        # the past days are served from the parsed file cache
+        results = read_files(filenames, history_pool())
+        mydata = []
+        for filename, (data, error) in zip(filenames, results):
+            if error is not None:
+                logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(filename) + " Exception: " + error)
+            mydata.append(data)
+        return mydata
+    def _range(self,):
         """
-        helper function for get_data
+        Start and end of the plot or the sum, None for an open end
         """
+        start, end = None, None
+        if self.caller == 1 and self.duration in DURATIONS:
+            start = datetime.now() - timedelta(seconds=DURATIONS[self.duration])
+        elif self.caller == 2:
+            start, end = self.start, self.end
+        return start, end
+    def _binlog_helper(self,):
+        """
+        helper function for get_data, slices the range of the plot or the sum out of the binary log
+        """
+        mydata = []
         try:
-            mydata = []
-            mydata.append(read_csv(filename, sep='\t', dtype={0:"str", 1: "float16", 2:"float16", 3:"float16"}, \
-                                   on_bad_lines='skip', na_filter=True, index_col=False, memory_map=True, low_memory=True, \
-                                   usecols=[0,1,2,3], engine='c', names=self.headers, na_values='nan'))
+            start, end = self._range()
+            recs = bpc_store.query_binlog(bpc_store.binlog_name(self.dirpath), start, end)
+            mydata.append(DataFrame({'Date': to_datetime(bpc_store.to_wall_ns(recs['time'])), 'Pressure': recs['pressure'], \
+                                     'Flow': recs['flow'], 'Valve': recs['valve']}))
         except Exception as e:
-            logger.info("In function: " +  inspect.stack()[0][3] + " In file: ", str(filename) + " Exception: " + str(e))
-            pass
+            logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+        return mydata
+    def _bin_seconds(self,):
+        """
+        Length of the bins in s, None for calendar bins like weeks and months
+        """
+        try:
+            return to_offset(self.binsize).nanos//10**9
+        except ValueError:
+            return None
+    def _bin_sums(self, df):
+        """
+        Means of the bins from the sums and counts of pressure, flow and valve of the buckets in df,
+        indexed by their start. The sum is served by the buckets as they are
+        """
+        if self.caller == 1:
+            df = df.resample(self.binsize, closed='left', label='left').sum()
+        binned = DataFrame({'Date': df.index})
+        for name, header in zip(bpc_store.COLUMNS, self.headers[1:]):
+            binned[header] = (df[name + '_sum']/df[name + '_count'].where(df[name + '_count'] > 0)).values
+        return binned
+    def _sqlite_helper(self,):
+        """
+        helper function for get_data, lets sqlite filter the range and aggregate the buckets
+        """
+        start, end = self._range()
+        fname = bpc_store.sqlite_name(self.dirpath)
+        if self.caller == 2:
+            rows = bpc_store.query_sqlite_sum(fname, start, end)
+            # only the flow is summed, a row holds the sum of the mean flow of the seconds of its minute
+            df = DataFrame({'Date': to_datetime(bpc_store.to_wall_ns([r[0] for r in rows])), 'Pressure': 0.0, \
+                            'Flow': [r[1] for r in rows], 'Valve': 0.0})
+            df.attrs['summed'] = True
+            return [df]
+        bin_seconds = self._bin_seconds()
+        # calendar bins are made of days
+        rows = bpc_store.query_sqlite(fname, bin_seconds if bin_seconds else 86400, start, end)
+        df = DataFrame(rows, columns=['Date'] + [name + agg for name in bpc_store.COLUMNS for agg in ('_count', '_sum')])
+        df['Date'] = to_datetime(bpc_store.to_wall_ns(df['Date'].values))
+        return [self._bin_sums(df.set_index('Date'))]
+    def _rollup_helper(self,):
+        """
+        helper function for get_data, serves the request from the rollup tiers.
+        Returns the binned data or None if no tier fits the binning
+        """
+        start, end = self._range()
+        # the sum is made of the 1 min buckets
+        bin_seconds = self._bin_seconds() if self.caller == 1 else 60
+        recs = bpc_store.query_rollups(self.dirpath, bin_seconds, start, end)
+        if recs is None:
+            return None
+        # the buckets start on the local wall clock
+        dates = to_datetime(bpc_store.to_wall_ns(recs['time']))
+        df = DataFrame({'Date': dates})
+        for name in bpc_store.COLUMNS:
+            df[name + '_sum'] = recs[name + '_sum']
+            df[name + '_count'] = recs[name + '_count']
+        # a bucket continued after a restart has more than one record
+        df = df.groupby('Date').sum()
+        binned = self._bin_sums(df)
+        if self.caller == 2:
+            # the sum adds up the mean flow of every second, one row stands for the seconds of its bucket
+            span = ((recs['end'] - recs['time'])//10**9 + 1)
+            seconds = DataFrame({'Date': dates, 'span': span}).groupby('Date').sum()['span']
+            binned['Flow'] = binned['Flow']*(df['flow_count'].clip(upper=seconds)).values
+            binned.attrs['summed'] = True
+        return [binned]
+    def _manifest_helper(self, manifest):
+        """
+        helper function for get_data, reads the files of the range found in the manifest and the
+        days written since it was updated. A day fully inside the sum is taken from the manifest
+        """
+        mydata = []
+        files = []
+        start, end = self._range()
+        for entry in manifest.select(start, end):
+            self.filename = entry['name']
+            if self.caller == 2 and bpc_store.wall_ns(start) <= entry['first'] and entry['last'] <= bpc_store.wall_ns(end):
+                # the sum adds up the mean flow of every second, only the flow is summed
+                seconds = min(entry['rows'], (entry['last'] - entry['first'])//10**9 + 1)
+                day = DataFrame({'Date': [to_datetime(entry['first'])], 'Pressure': [0.0], \
+                                 'Flow': [entry['flow_sum']*seconds/entry['rows']], 'Valve': [0.0]})
+                day.attrs['summed'] = True
+                mydata.append([day])
+            else:
+                files.append(self.dirpath + sep + entry['name'])
+        mydata.extend(self._read_helper(files + manifest.unindexed(end)))
         return mydata
-    @functools.lru_cache(maxsize=128)
+    def _resample(self, data, origin='start_day'):
+        """
+        Means of the bins of the list of dataframes data with the lHe rec. added, indexed by
+        the start of the bins. Empty bins are dropped
+        """
+        dfc = concat(data, ignore_index=True)
+        dfc['Date'] = to_datetime(dfc['Date'], utc=False, format="ISO8601")
+        dfc.insert(4, "lHe Rec. [ltrs/day]", dfc['Flow']*60*24/(expansion_ratio))
+        dfc.insert(5, "lHe Rec. [ltrs/sec]", (dfc['Flow']/60)/(expansion_ratio))
+        dfc.insert(6, "Timestamp", dfc.Date.values.astype(int64)//10**9)
+        dfc.set_index('Date', inplace=True)
+        # print (dfc.head(5))
+        resample_dfc = dfc.resample(self.binsize, closed='left', label='left', origin=origin).mean()
+        resample_dfc.dropna(axis=0, inplace=True)
+        resample_dfc['Date'] = resample_dfc.index
+        return resample_dfc
+    def _sum_rows(self, data):
+        """
+        Rows of the sum from the list of dataframes data. The rows of the stores and the manifest hold
+        the flow already summed over the seconds of their bucket and are taken as they are, the samples
+        of the binary log and the daily files are averaged per second. Only seconds with samples are binned
+        """
+        frames = [df for df in data if df.attrs.get('summed')]
+        samples = [df for df in data if not df.attrs.get('summed')]
+        if samples != []:
+            dfs = concat(samples, ignore_index=True)
+            seconds = to_datetime(dfs.pop('Date'), utc=False, format="ISO8601").dt.floor('s')
+            dfs = dfs.groupby(seconds.values).mean().dropna(axis=0)
+            dfs.insert(0, 'Date', dfs.index)
+            frames.append(dfs)
+        dfc = concat(frames, ignore_index=True)
+        dfc['Date'] = to_datetime(dfc['Date'], utc=False, format="ISO8601")
+        dfc.insert(4, "lHe Rec. [ltrs/day]", dfc['Flow']*60*24/(expansion_ratio))
+        dfc.insert(5, "lHe Rec. [ltrs/sec]", (dfc['Flow']/60)/(expansion_ratio))
+        dfc.insert(6, "Timestamp", dfc.Date.values.astype(int64)//10**9)
+        dfc.dropna(axis=0, inplace=True)
+        dfc.sort_values('Date', inplace=True)
+        dfc.set_index('Date', drop=False, inplace=True)
+        return dfc
+    def _follow_helper(self,):
+        """
+        helper function for get_data in follow mode, bins the lines logged since the start of the
+        last bin of the previous plot and replaces that bin. The lines are always read from the
+        daily files, today's file by TAIL, whichever store served the previous plot
+        """
+        last = self.previous.index[-1]
+        now = datetime.now()
+        filenames = [bpc_store.txt_name(self.dirpath, last + timedelta(days=n)) \
+                     for n in range((now.date() - last.date()).days + 1)]
+        data = []
+        for df in self._read_helper([f for f in filenames if bpc_store.day_file(f) is not None]):
+            data.extend(df)
+        data = [df[df['Date'] >= last] for df in data]
+        data = [df for df in data if len(df) > 0]
+        if data == []:
+            return self.previous
+        # on the bins of the previous plot
+        binned = self._resample(data, origin=self.previous.index[0])
+        return concat([self.previous[self.previous.index < last], binned])
     def get_data(self,):
         mydata = []
         data   = []
+        files  = []
         get_data_start = perf_counter()
+        if self.previous is not None and len(self.previous) > 0:
+            try:
+                resample_dfc = self._follow_helper()
+                logger.info("Time taken to follow the data: " + str(perf_counter() - get_data_start))
+                return resample_dfc
+            except Exception as e:
+                # plot it all again
+                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
         try:
             i = 0
-            for filename in scandir(self.dirpath + '\\'):
+            if args.rollup and bpc_store.store_complete(self.dirpath, 'rollup'):
+                binned = self._rollup_helper()
+                if binned is not None:
+                    mydata.append(binned)
+            if mydata == [] and args.sqlite and bpc_store.store_complete(self.dirpath, 'sqlite'):
+                mydata.append(self._sqlite_helper())
+            # only while the writer keeps it up to date and once it holds the whole archive
+            if mydata == [] and args.binlog and bpc_store.store_complete(self.dirpath, 'binlog'):
+                mydata.append(self._binlog_helper())
+            indexed = False
+            if mydata == [] and self.caller in (1, 2):
+                manifest = bpc_store.Manifest(self.dirpath)
+                if manifest.load():
+                    mydata.extend(self._manifest_helper(manifest))
+                    indexed = True
+            for filename in ([] if mydata != [] or indexed else scandir(self.dirpath + '\\')):
                 self.filename = filename.name
-                if self.filename != '' and (self.filename.split('.')[-1]).rstrip() == 'txt':
+                if self.filename != '' and self.filename.rstrip().endswith(('.txt', '.txt.gz')):
                     if self.caller == 1: # plot data
                         if self.duration == 'all':
                             # print ("appending all data...")
-                            mydata.append(self._read_helper(datadir + sep + filename.name))
+                            files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '365 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 3.1536*1e7):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '180 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 1.5552*1e7):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '90 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 7.776*1e6):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '30 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 2.592*1e6):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '14 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 1.2096*1e6):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '7 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 604800):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         elif self.duration == '2 days':
                             fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                             delta_time = (datetime.now() - fname_date).total_seconds()
                             if (float(delta_time) <= 172800):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                         else:
-                            mydata.append(self._read_helper(datadir + sep + filename.name))
+                            files.append(self.dirpath + sep + filename.name)
 
                     elif self.caller == 2: # sum calculation
                         fname_date = datetime.strptime((((filename.name.split('.')[0])).split('_')[-1]), "%Y%m%d")
                         if ((datetime.timestamp(fname_date) >=self.start or datetime.timestamp(fname_date) >=self.start) and \
                            (datetime.timestamp(fname_date) <=self.end)):
-                                mydata.append(self._read_helper(datadir + sep + filename.name))
+                                files.append(self.dirpath + sep + filename.name)
                     else:
                         mydata = []
+            mydata.extend(self._read_helper(files))
         except:
             logger.info('Error reading file/getting data in filename: ' + str(self.filename) + ' ' + str(inspect.stack()[0][3]))
             pass
@@ -434,16 +535,8 @@ class Worker(QRunnable):
             logger.info("Empty dataset")
             pass
         if data != []:
-            dfc = concat(data, ignore_index=True)
-            dfc['Date'] = to_datetime(dfc['Date'], utc=False, format="ISO8601")
-            dfc.insert(4, "lHe Rec. [ltrs/day]", dfc['Flow']*60*24/(expansion_ratio))
-            dfc.insert(5, "lHe Rec. [ltrs/sec]", (dfc['Flow']/60)/(expansion_ratio))
-            dfc.insert(6, "Timestamp", dfc.Date.values.astype(int64)//10**9)
-            dfc.set_index('Date', inplace=True)
-            # print (dfc.head(5))
-            resample_dfc = dfc.resample(self.binsize, closed='left', label='left').mean()
-            resample_dfc.dropna(axis=0, inplace=True)
-            resample_dfc['Date'] = resample_dfc.index
+            # the sum needs no empty bins of a second
+            resample_dfc = self._sum_rows(data) if self.caller == 2 else self._resample(data)
             get_data_end = perf_counter() - get_data_start
             logger.info("Time taken to get and analyze data: " +  str(get_data_end))
             return (resample_dfc)
@@ -456,18 +549,11 @@ class Worker(QRunnable):
         -------
         resample_dfb : dataframe
         """
-        global WORKERS
         dfb = []
-        if main_window.btn_sum_rec.isChecked():
-            self.binsize = '1S'
-        else:
-            self.binsize = main_window.cb_resample.currentText()
         try:
-            with ThreadPoolExecutor(max_workers=WORKERS) as executor:
-                y1 = (executor.submit(self.get_data))
-            # print("This is result", y1.result())
-            if y1.result() is not None:
-                dfb = y1.result()
+            # runs in the thread of the QRunnable, the files are parsed by the process pool
+            dfb = self.get_data()
+            if dfb is not None:
                 return (dfb)
             else:
                 return
@@ -479,27 +565,24 @@ class Worker(QRunnable):
     def run(self):
         """
         """
-        global df_bpcCtrl
         try:
             thread_start = perf_counter()
             df_bpcCtrl = self.get_bpc_data()
             thread_fin = perf_counter() - thread_start
             logger.info ('Time taken to get and analyze all data: ' \
                          + str(thread_fin))
-            self.signals.mysignalfin.emit()
+            self.signals.mysignalfin.emit(df_bpcCtrl)
                 # convert dataframe to list
                 # dfp_list = dfp.values.tolist()
                 # dfc_list = dfc.values.tolist()
                 # dfm_list = dfm.values.tolist()
         except Exception as e:
             logger.info ("Error in function " + inspect.stack()[0][3] + ': ' + str(e))
-            main_window.btn_plot.setEnabled(True)
-            main_window.btn_sum_rec.setEnabled(True)
-            pass
+            self.signals.mysignalfin.emit(None)
 
 class aboutWindow(QWidget):
 
-    def __init__(self):
+    def __init__(self, ctrl):
         super().__init__()
         self.setWindowTitle("About")
         self.setWindowIcon(QIcon(base_dir + r'\icons\main.jpg'))
@@ -509,10 +592,18 @@ class aboutWindow(QWidget):
         self.te_about.setPlainText("Developer & Maintainer: Alireza Panna")
         self.te_about.append("Co-Maintainer: Frank Seifert")
         self.te_about.append("Email: alireza.panna@nist.gov & frank.seifert@nist.gov")
-        self.te_about.append("EPICS PV for this server: " + str(PV))
+        self.te_about.append("Controller: " + str(ctrl.host) + ':' + str(ctrl.port))
+        self.te_about.append("EPICS PV for this server: " + str(ctrl.pv))
         self.te_about.append("EPICS records: " + str(list(pvdb.keys())))
-        self.te_about.append("Current data folder: " + str(datadir))
+        self.te_about.append("Current data folder: " + str(ctrl.datadir))
         self.te_about.append("Current log folder: " + str(logdir))
+        snap = ctrl.link_stats
+        if snap is not None:
+            self.te_about.append("Link over the last " + str(int(snap['seconds']/60)) + " min: " + \
+                                 str(snap['errors']) + " errors, " + str(snap['reconnects']) + " reconnects")
+            for command, c in snap['commands'].items():
+                self.te_about.append("  " + command + " round trip: mean " + str(round(c['mean_ms'], 1)) + \
+                                     " ms, p99 " + str(c['p99_ms']) + " ms, max " + str(round(c['max_ms'], 1)) + " ms")
 
         layout = QVBoxLayout()
         layout.addWidget(self.te_about)
@@ -552,10 +643,11 @@ class CustomToolbar(NavigationToolbar):
 
 class mainWindow(QTabWidget):
 
-    def __init__(self):
+    def __init__(self, ctrl, mthread):
         global HIST
         global MAIN_THREAD_POLL
         QTabWidget.__init__(self)
+        self.ctrl = ctrl
         # self.setWindowIcon(QIcon(".\\icons\\main.ico"))
         self.tab1 = QWidget()
         self.addTab(self.tab1, "Viewer")
@@ -570,20 +662,11 @@ class mainWindow(QTabWidget):
         self.timer = QTimer()
         # self.timer.setTimerType(QtCore.Qt.PreciseTimer)
         self.timer.timeout.connect(self.calc_uptime)
-        self.email_timer = QTimer()
-        self.email_timer.timeout.connect(self.send_email)
-        self.restore_start_lHe = ''
-        self.fname = datadir + '\\bpc_log_' + strftime("%Y%m%d") + '.txt'
-        self.save_restore_fname = datadir + '\\bpc_save_restore' + '.sav'
-        try:
-            with open(self.save_restore_fname, 'r') as f:
-                restore_start_lHe = (f.read()).split(' ')[-1]
-                if (isDigit(restore_start_lHe)):
-                    self.restore_start_lHe = restore_start_lHe
-        except Exception as e:
-            self.restore_start_lHe = ''
-            logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
-            pass
+        # the lHe start restored from the checkpoint, else the remaining lHe of the last run is offered
+        if ctrl.start_lHe != '':
+            self.restore_start_lHe = ctrl.start_lHe
+        else:
+            self.restore_start_lHe = ctrl.restore()
         self.tab1_ui()
         self.tab2_ui()
         # self.tab3_ui()
@@ -601,14 +684,9 @@ class mainWindow(QTabWidget):
         self.plot_settings()
         self.data_pressure = deque(maxlen=int(86400/(HIST*MAIN_THREAD_POLL*1e-3)))
         self.data_flow = deque(maxlen=int(86400/(HIST*MAIN_THREAD_POLL*1e-3)))
-        # start the main thread
-        self.mthread = mainThread()
-        self.mthread.start()
-        self.mthread.update_data.connect(self._getAllData)
-        self.mthread.plot_temp.connect(self.plot_data)
-        self.mthread.lHe_est_time_to_threshold.connect(self.set_est_lHe)
-        self.mthread.rec_signal.connect(self.set_recovered)
-        self.mthread.remaining_lHe_signal.connect(self.set_remaining_lHe)
+        # the main thread polls all controllers, it is started once all windows are connected
+        self.mthread = mthread
+        self.mthread.sample_signal.connect(self.set_sample)
 
         self.threadpool = QThreadPool()
 
@@ -649,8 +727,6 @@ class mainWindow(QTabWidget):
 
         self._create_menubar()
 
-        if PV != '':
-            self.drv = myDriver()
         #logger.info ("In function: " + inspect.stack()[0][3])
         self.start_time = time()
         if getattr(sys, 'frozen', False):
@@ -664,7 +740,7 @@ class mainWindow(QTabWidget):
         self.help_menu.addAction(self.about_action)
 
     def _about(self,):
-        self.about_window = aboutWindow()
+        self.about_window = aboutWindow(self.ctrl)
         self.about_window.show()
 
     def tab1_ui(self, ):
@@ -887,7 +963,9 @@ class mainWindow(QTabWidget):
         self.le_start_ltr.setGeometry(QtCore.QRect(119, 204, 51, 25))
         self.le_start_ltr.returnPressed.connect(self.lHe_start_updated)
         self.le_start_ltr.setText(self.restore_start_lHe)
-        self.lHe_start_updated()
+        # not an edit, the integration restored from the checkpoint goes on
+        self.ctrl.start_lHe = self.le_start_ltr.text()
+        self.lbl_lHe_per_remain_rbv.setText(self.le_start_ltr.text())
         self.le_start_ltr.setObjectName("le_start_ltr")
 
         self.lbl_lHe_threshold = QLabel(parent=self.tab1)
@@ -901,8 +979,8 @@ class mainWindow(QTabWidget):
         self.le_lHe_threshold = QLineEdit(parent=self.tab1)
         self.le_lHe_threshold.setValidator(QDoubleValidator(0, 10000, 3))
         self.le_lHe_threshold.setGeometry(QtCore.QRect(119, 234, 51, 25))
-        if THRESHOLD_LHE != '':
-            self.le_lHe_threshold.setText(THRESHOLD_LHE)
+        if self.ctrl.threshold_lHe != '':
+            self.le_lHe_threshold.setText(self.ctrl.threshold_lHe)
         self.le_lHe_threshold.returnPressed.connect(self.lHe_threshold_updated)
         self.le_lHe_threshold.setObjectName("le_lHe_threshold")
 
@@ -984,6 +1062,19 @@ class mainWindow(QTabWidget):
         self.btn_plot.setFixedWidth(60)
         self.btn_plot.clicked.connect(self.start_plot_data_thread)
 
+        # re-plot every FOLLOW_POLL ms, only the new lines of today's file are parsed
+        self.btn_follow = QPushButton('FOLLOW', self)
+        self.btn_follow.setToolTip('Re-plot the data every ' + str(FOLLOW_POLL//1000) + ' s')
+        self.btn_follow.setCheckable(True)
+        self.btn_follow.setFixedHeight(25)
+        self.btn_follow.setFixedWidth(60)
+        self.btn_follow.toggled.connect(self.follow)
+        self.follow_timer = QTimer()
+        self.follow_timer.timeout.connect(self.follow_plot)
+        # (duration, binning) and data of the last plot
+        self.follow_base = (None, None)
+        self.plot_key = None
+
         self.startdt = QDateTimeEdit(self, calendarPopup=True)
         # self.startdt.dateTimeChanged.connect(self.update)
         self.enddt = QDateTimeEdit(self, calendarPopup=True)
@@ -1008,6 +1099,7 @@ class mainWindow(QTabWidget):
         layout2.addWidget(self.lbl_resample)
         layout2.addWidget(self.cb_resample)
         layout2.addWidget(self.btn_plot)
+        layout2.addWidget(self.btn_follow)
         layout2.addStretch(1)
         layout1.addWidget(self.startdt)
         layout1.addWidget(self.enddt)
@@ -1022,19 +1114,41 @@ class mainWindow(QTabWidget):
         self.tab2.setLayout(layout)
 
     def start_plot_data_thread(self,):
+        self._start_plot_worker(None)
+
+    def _start_plot_worker(self, previous):
         self.start_work = perf_counter()
         self.caller_id = 1
         self.btn_plot.setEnabled(False)
         self.btn_sum_rec.setEnabled(False)
-        worker = Worker(datadir, self.cb_time.currentText(), self.caller_id, 0, 0)
+        self.plot_key = (self.cb_time.currentText(), self.cb_resample.currentText())
+        worker = Worker(self.ctrl.datadir, self.cb_time.currentText(), self.caller_id, 0, 0, \
+                        self.cb_resample.currentText(), previous)
         worker.signals.mysignalfin.connect(self.redraw)
         self.threadpool.start(worker)
 
-    def redraw(self,):
+    def follow(self, checked):
+        if checked:
+            self.follow_plot()
+            self.follow_timer.start(FOLLOW_POLL)
+        else:
+            self.follow_timer.stop()
+
+    def follow_plot(self,):
+        # skip while the last plot or sum is still being served
+        if self.btn_plot.isEnabled():
+            key, previous = self.follow_base
+            # only the tail is binned again while duration and binning are unchanged
+            if key != (self.cb_time.currentText(), self.cb_resample.currentText()):
+                previous = None
+            self._start_plot_worker(previous)
+
+    def redraw(self, df_bpcCtrl):
         redraw_start = perf_counter()
+        self.follow_base = (self.plot_key, df_bpcCtrl)
         self.sc.ax1.clear()
         try:
-            self.plot_history_data()
+            self.plot_history_data(df_bpcCtrl)
             logger.info('Time taken plot the data and draw canvas: ' + \
                         str(perf_counter() - redraw_start) + '\n')
         except:
@@ -1049,9 +1163,8 @@ class mainWindow(QTabWidget):
         # self.p.join()
         # self.sc.fig.tight_layout()
 
-    def plot_history_data(self, ):
+    def plot_history_data(self, df_bpcCtrl):
         #logger.info ('In function: ' + inspect.stack()[0][3])
-        global df_bpcCtrl
         try:
             if self.draw_bpc_flag == 1:
                 self.plot1_ref[0].set_data(df_bpcCtrl['Date'], df_bpcCtrl['lHe Rec. [ltrs/day]'])
@@ -1081,8 +1194,8 @@ class mainWindow(QTabWidget):
         QMainWindow.show(self)
         self.sc.fig.tight_layout()
 
-        # run the main thread every 1s
-        self.timer.start(MAIN_THREAD_POLL)
+        # update the uptime every 1s
+        self.timer.start(1000)
         self.timer_start = perf_counter()
 
     def _exit_app(self):
@@ -1093,108 +1206,44 @@ class mainWindow(QTabWidget):
         self.quit_flag = 1
         self.quit()
 
-    def _getAllData(self, all_rbv):
-         # print("% remain:", all_rbv[-1])
-         try:
-             self.timestamp = datetime.now()
-             self.lbl_pressure_rbv.setText(str(round(all_rbv[20], 3)))
-             self.lbl_flow_rbv.setText(str(round(all_rbv[10]*correction, 3)))
-             self.lbl_valve_rbv.setText(str(round(all_rbv[-1], 3)))
-             # rec = all_rbv[10]*60*24/(expansion_ratio)
-             # write to epics pv records
-             if PV != '':
-                 self.drv.write('PRESSURE', all_rbv[20])
-                 self.drv.write('VALVE', all_rbv[-1] )
-                 self.drv.write('HE_FLOW', all_rbv[10]*correction)
-                 self.drv.updatePVs()
-         except Exception as e:
-             logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
-             pass
+    def set_sample(self, sample):
+        """
+        Shows and plots one sample of the controller of this window
+        """
+        if sample.ctrl is not self.ctrl:
+            return
+        try:
+            self.timestamp = sample.timestamp
+            self.lbl_pressure_rbv.setText(str(round(sample.pressure, 3)))
+            self.lbl_flow_rbv.setText(str(round(sample.flow, 3)))
+            self.lbl_valve_rbv.setText(str(round(sample.valve, 3)))
+            self.lbl_rec_rbv.setText(str(round(sample.recovered, 3)))
+            if isnan(sample.remaining_lHe):
+                self.lbl_lHe_per_remain_rbv.setText('')
+            else:
+                self.lbl_lHe_per_remain_rbv.setText(str(round(sample.remaining_lHe, 3)))
+            if sample.time_to_threshold == Inf:
+                self.lbl_lHe_threshold_time_est_rbv.setText('')
+            else:
+                self.lbl_lHe_threshold_time_est_rbv.setText(str(round(sample.time_to_threshold, 2)) + ' days')
+        except Exception as e:
+            logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+            pass
+        self.plot_data(sample)
 
     def lHe_start_updated(self,):
-        global START_LHE
-        global START_LHE_CHANGED
-        START_LHE = self.le_start_ltr.text()
+        self.ctrl.start_lHe = self.le_start_ltr.text()
         self.lbl_lHe_per_remain_rbv.setText(self.le_start_ltr.text())
-        START_LHE_CHANGED = 1
-        # stop the email timer if the lHe start is updated
-        if self.email_timer.isActive():
-            self.email_timer.stop()
+        # the poller restarts the integration and re-arms the threshold email
+        self.ctrl.start_lHe_changed = 1
 
     def lHe_threshold_updated(self,):
-        global THRESHOLD_LHE
-        THRESHOLD_LHE = self.le_lHe_threshold.text()
-        if self.lbl_lHe_per_remain_rbv.text() != '':
-            if float(self.lbl_lHe_per_remain_rbv.text()) >= float(THRESHOLD_LHE):
-            # stop the email timer if the lHe start is updated
-                if self.email_timer.isActive():
-                    self.email_timer.stop()
-
-    def set_est_lHe(self, calc_time_to_threshold):
-        if calc_time_to_threshold == Inf:
-            self.lbl_lHe_threshold_time_est_rbv.setText('')
-        else:
-            self.lbl_lHe_threshold_time_est_rbv.setText(str(round(calc_time_to_threshold, 2)) + ' days')
-        if PV != '':
-            self.drv.write('LHE_FIN', float(calc_time_to_threshold))
-            self.drv.updatePVs()
-
-    def set_recovered(self, recovered):
-        self.lbl_rec_rbv.setText(str(round(recovered, 3)))
-        if PV != '':
-            self.drv.write('LHE_RECOVERED', recovered)
-            self.drv.updatePVs()
-
-    def set_remaining_lHe(self, remaining_lHe):
-        global EMAIL_POLL
-        global THRESHOLD_LHE
-        if isnan(remaining_lHe):
-            self.lbl_lHe_per_remain_rbv.setText('')
-        else:
-            self.lbl_lHe_per_remain_rbv.setText(str(round(remaining_lHe, 3)))
-        if THRESHOLD_LHE != '' and not isnan(remaining_lHe):
-            if remaining_lHe <= float(THRESHOLD_LHE):
-                if receiver != ['']:
-                    if not self.email_timer.isActive():
-                        self.send_email()
-                        # self.email_timer.start(3600000) # test
-                        self.email_timer.start(int(EMAIL_POLL))
-        if PV != '':
-            self.drv.write('LHE_LEFT', remaining_lHe)
-            self.drv.updatePVs()
-
-    def send_email(self,):
-        resource = "smtp.nist.gov"
-        port = 25
-        sender = "alireza.panna@nist.gov"
-        subject = "LHe at threshold"
-        body = """ <html>
-                   <head></head>
-                   <body>
-                   <p>Hello user,<br>
-                      The LHe level in your dewar is below the set threshold level.<br>
-                      Remaining lHe in your dewar: """ + self.lbl_lHe_per_remain_rbv.text() + """ ltrs
-                     <br>Please re-fill or exchange dewar.<br><br>
-                      Thank you<br><br>
-                      Best,<br>
-                      Your friendly service galley lHe monitor
-                   </p>
-                   </body>
-                   </html> """
-        msg = MIMEText(body, "html")
-        msg["From"] = sender
-        msg["Subject"] = subject
-        msg["To"] = ", ".join(receiver)
-        smtp_server = SMTP(resource, port)
-        try:
-            smtp_server.sendmail(sender, receiver, msg.as_string())
-        finally:
-            smtp_server.quit()
+        # the poller re-arms the threshold email once the remaining lHe is above the new threshold
+        self.ctrl.threshold_lHe = self.le_lHe_threshold.text()
 
     def calc_uptime(self):
         """
         A QTimer is used to calculate uptime every second.
-        We also use this to update the filename of the data file
         """
         try:
             up = timedelta(seconds=(time() - self.start_time))
@@ -1204,7 +1253,6 @@ class mainWindow(QTabWidget):
             secs = int(up.seconds%60)
             self.le_uptime.setText(str(days) + 'd, ' + str(hours) + \
                                   ':' + str(mins) + ':' + str(secs))
-            self.fname = datadir + '\\bpc_log_' + strftime("%Y%m%d") + '.txt'
         except Exception as e:
             logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
             pass
@@ -1291,27 +1339,15 @@ class mainWindow(QTabWidget):
             co = co+n
         return(binned)
 
-    @QtCore.pyqtSlot()
-    def plot_data(self):
+    def plot_data(self, sample):
         global HIST
         #logger.info("In function: " + inspect.stack()[0][3])
         # convert datetime object to timestamp
-        ct = self.timestamp.timestamp()
-        pressure = self.lbl_pressure_rbv.text()
-        flow = self.lbl_flow_rbv.text()
-        rec = self.lbl_rec_rbv.text()
-        valve = self.lbl_valve_rbv.text()
-
-        if pressure != 'nan' or flow != 'nan' or valve != 'nan':
-            self.data_pressure.append({'x':ct, 'y':float(pressure),})
-            self.data_flow.append({'x':ct, 'y':float(rec),})
-            with open(self.fname, 'a') as f:
-                f.write(str(self.timestamp) + '\t' + str(pressure) + '\t' + str(flow) + '\t' + str(valve) + '\n')
-            self.lbl_lHe_per_remain_rbv.text().rstrip('\s')
-            self.lbl_lHe_per_remain_rbv.text().lstrip('\s')
-            with open(self.save_restore_fname, 'w') as f:
-                if str(self.lbl_lHe_per_remain_rbv.text() != '' and isDigit(self.lbl_lHe_per_remain_rbv.text())):
-                    f.write(str(datetime.now())[:-3] + ' lHe remaining [ltrs]: ' + str(self.lbl_lHe_per_remain_rbv.text()))
+        ct = sample.timestamp.timestamp()
+        # the data file is written by the poller
+        if sample.valid():
+            self.data_pressure.append({'x':ct, 'y':sample.pressure,})
+            self.data_flow.append({'x':ct, 'y':sample.recovered,})
         ct_list = [item['x'] for item in self.data_flow]
         pressure_list = [item['y'] for item in self.data_pressure]
         flow_list = [item['y'] for item in self.data_flow]
@@ -1383,24 +1419,14 @@ class mainWindow(QTabWidget):
             QMessageBox.StandardButton.Yes)
             if reply == QMessageBox.StandardButton.Yes:
                 self.quit_flag = 1
-                if not debug_mode:
-                    mybpc.close_comm()
-                if PV != '':
-                    server_thread.stop()
-                self.mthread.stop()
-                file_handler.close()
+                _shutdown()
                 self.close()
                 QtCore.QCoreApplication.instance().quit
                 app.quit()
             else:
                 pass
         if self.quit_flag == 1:
-            if not debug_mode:
-                mybpc.close_comm()
-            if PV != '':
-                server_thread.stop()
-            self.mthread.stop()
-            file_handler.close()
+            _shutdown()
             self.close()
             QtCore.QCoreApplication.instance().quit
             app.quit()
@@ -1413,17 +1439,16 @@ class mainWindow(QTabWidget):
          self.caller_id = 2
          x=self.startdt.dateTime().toPyDateTime().timestamp()
          y=self.enddt.dateTime().toPyDateTime().timestamp()
-         worker = Worker(datadir, 'None', self.caller_id, x, y)
+         worker = Worker(self.ctrl.datadir, 'None', self.caller_id, x, y, self.binsize)
          worker.signals.mysignalfin.connect(self.show_sum)
          self.threadpool.start(worker)
 
-    def show_sum(self,):
+    def show_sum(self, df_bpcCtrl):
          """
          Returns
          -------
          None.
          """
-         global df_bpcCtrl
          new_df = None
          try:
              # print(df_bpcCtrl)
@@ -1454,104 +1479,48 @@ def _sigint_handler(*args):
     Handler for the SIGINT signal. For testing purposes only
     """
     sys.stderr.write('\r')
-    if PV != '':
+    if server_thread is not None:
         server_thread.stop()
     QtGui.QApplication.quit()
 
-def isDigit(x):
-    try:
-        float(x)
-        return True
-    except ValueError:
-        return False
-
-def dir_path(save_path):
-    save_path = str(save_path)
-    if not path.isdir(save_path):
-        mkdir(save_path)
-    return save_path
-
-def range_limited_float_type(arg):
+def _shutdown():
     """
-    Type function for argparse - a float within some predefined bounds
+    Stops polling, writes the queued samples, closes all controller connections and the pcas server
     """
-    MIN_VAL = 1
-    MAX_VAL = 2
-    try:
-        f = float(arg)
-    except ValueError:
-        raise ArgumentTypeError("Must be a floating point number")
-    if f < MIN_VAL or f > MAX_VAL:
-        raise ArgumentTypeError("Argument must be <= " + str(MAX_VAL) + " and >= " + str(MIN_VAL))
-    return f
+    global shutdown_done
+    if shutdown_done:
+        return
+    shutdown_done = True
+    mthread.stop()
+    writer.stop()
+    for ctrl in controllers:
+        if ctrl.driver is not None:
+            ctrl.driver.close_comm()
+    if server_thread is not None:
+        server_thread.stop()
+    if POOL is not None:
+        POOL.shutdown(wait=False)
+    file_handler.close()
 
 if __name__ == '__main__':
-    # user options to run multiple instances with different configurations for example
-    parser = ArgumentParser(prog = 'bpc-monitor',
-                            description='Configure bpc-monitor.',
-                            epilog='A utility to log data and estimate lHe usage from the back pressure controller', add_help=True)
-    parser.add_argument('-i', '--host', help='specify the host address', default='172.30.33.212')
-    parser.add_argument('-p', '--port',  help='specify the port', default='20256', type=int)
-    parser.add_argument('-e', '--epics_pv',  help='Specify the PV epics prefix', default='')
-    parser.add_argument('-s', '--save_path', help='Specify data directory', default="C:" + sep + "_datacache_", type=dir_path)
-    parser.add_argument('-l', '--log_path', help='Specify log directory', default="C:" + sep + "_logcache_", type=dir_path)
-    parser.add_argument('-d', '--debug', help='Debugging mode', action='store_true')
-    parser.add_argument('-dl', '--debug_log', help='Save all debugging logs', action='store_true')
-    parser.add_argument('-t', '--threshold',  help='Specify lHe threshold in ltrs', default='', type=str)
-    parser.add_argument('-c', '--correction',  help='Specify correction factor between 1.0 and 2.0', default='1.0', type=range_limited_float_type)
-    parser.add_argument('-rv','--expansion_ratio', help='Specify the helium gas to liquid expansion ratio', default=754.2, type=float)
-    parser.add_argument('-m', '--mail', help='Specify receipients email address', default='')
-    args, unk = parser.parse_known_args()
-    if unk:
-        logger.info("Warning: Ignoring unknown arguments: {:}".format(unk))
-        pass
-    myserver = args.host
-    port = args.port
-    PV = args.epics_pv
+    # user options to run multiple instances with different configurations for example,
+    # --headless is handled before the gui imports at the top of this file
+    args, unk = arg_parser().parse_known_args()
     datadir = args.save_path
     logdir = args.log_path
     debug_mode = args.debug
-    threshold = args.threshold
-    correction = args.correction
-    debug_log_flag = args.debug_log
     expansion_ratio = args.expansion_ratio
-    receiver = args.mail.split(';')
-
-    if correction == '':
-        correction = 1.0
-    if threshold != '':
-        THRESHOLD_LHE = threshold
-    else:
-        THRESHOLD_LHE = ''
-    # print('Server: ', myserver,
-    #       'Port: ', port,
-    #       'PV: ', PV,
-    #       'Datadir: ', datadir,
-    #       'Logdir: ', logdir,
-    #       'Receiver: ', receiver,
-    #       'Debug mode: ', debug_mode,
-    #       'Threshold: ', THRESHOLD_LHE,
-    #       'Correction: ', correction,
-    #       'Debug log: ', debug_log_flag,
-    #       'He Expansion Ratio: ', expansion_ratio)
-    # define the file handler and formatting
-    lfname = logdir + sep + 'bpc-monitor' + '.log'
-    file_handler = TimedRotatingFileHandler(lfname, when='midnight')
-    fmt = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
-    file_handler.setFormatter(fmt)
-    logger.addHandler(file_handler)
-    logger.info('Starting the bpc-monitor with the following settings: ' + \
-                'Server: ' + str(myserver) + \
-                ', Port: ' +  str(port) + \
-                ', PV: ' +  str(PV) + \
-                ', Datadir: ' + str(datadir) + \
-                ', Logdir: ' + str(logdir) + \
-                ', Receiver: ' + str(receiver) + \
-                ', Debug mode: ' + str(debug_mode) + \
-                ', Save debug log: ' + str(debug_log_flag) + \
-                ', Threshold: ' + THRESHOLD_LHE + \
-                ', Correction Factor: ' + str(correction) + \
-                ', Helium Expansion Ratio: ' + str(expansion_ratio))
+    MAIN_THREAD_POLL = args.rate
+    controllers = make_controllers(args)
+    file_handler = start_logging(args, controllers)
+    if unk:
+        logger.info("Warning: Ignoring unknown arguments: {:}".format(unk))
+        pass
+    for ctrl in controllers:
+        ctrl.load_checkpoint(expansion_ratio)
+    configure_cache(args.cache_size, args.cache_dir, args.cache_dir_size)
+    for ctrl in controllers:
+        Thread(target=warm_cache, args=(ctrl.datadir, args.cache_warm), name='warm_cache', daemon=True).start()
     # logger.info("In function: " +  inspect.stack()[0][3] + "EPICS PV for this server: " + str(PV))
     # Handle high resolution displays:
     if hasattr(QtCore.Qt, 'AA_EnableHighDpiScaling'):
@@ -1560,34 +1529,43 @@ if __name__ == '__main__':
         QApplication.setAttribute(QtCore.Qt.AA_UseHighDpiPixmaps, True)
     # Create the Qt application
     app = QApplication(sys.argv)
-    # create pcas server
-    if PV != '':
-        if not PV.endswith(':'):
-            prefix = PV + ':'
-        else:
-            prefix = PV
-        server = SimpleServer()
-        server.createPV(prefix, pvdb)
+    # create one pcas server for all controllers, the record names carry the prefix of their controller
+    server_thread = None
+    shutdown_done = False
+    server, drv = start_pcas(controllers)
     if not debug_mode:
-        mybpc = Vision130.Vision130Driver(myserver, port)
-    # Create the main window
-    main_window = mainWindow()
-    # Remove the title bar and set to fixed geometry to match our touch screen display
-    # main_window.setWindowFlags(QtCore.Qt.FramelessWindowHint)
-    main_window.setGeometry(500, 500, WIDTH, HEIGHT)
-    # Set the program version
-    if debug_mode:
-        main_window.setWindowTitle("BPC Monitor " + __version__ + ' Debug mode')
-    else:
-        main_window.setWindowTitle("BPC Monitor " + __version__)
-    main_window.setWindowIcon(QIcon(base_dir + r'\icons\main.jpg'))
-    main_window.show()
+        for ctrl in controllers:
+            ctrl.driver = Vision130.Vision130Driver(ctrl.host, ctrl.port, mode=args.pcom)
+    writer = start_writer(args, controllers)
+    poller = Poller(controllers, MAIN_THREAD_POLL, expansion_ratio, args.mail.split(';'), drv, \
+                    simulate=debug_mode, debug_log=args.debug_log, writer=writer, \
+                    checkpoint_interval=args.checkpoint)
+    mthread = mainThread(poller)
+    # Create the main windows, one per controller
+    main_windows = []
+    for n, ctrl in enumerate(controllers):
+        main_window = mainWindow(ctrl, mthread)
+        # Remove the title bar and set to fixed geometry to match our touch screen display
+        # main_window.setWindowFlags(QtCore.Qt.FramelessWindowHint)
+        main_window.setGeometry(500 + 30*n, 500 + 30*n, WIDTH, HEIGHT)
+        # Set the program version
+        title = "BPC Monitor " + __version__
+        if len(controllers) > 1:
+            title = title + ' - ' + str(ctrl)
+        if debug_mode:
+            title = title + ' Debug mode'
+        main_window.setWindowTitle(title)
+        main_window.setWindowIcon(QIcon(base_dir + r'\icons\main.jpg'))
+        main_window.show()
+        main_windows.append(main_window)
+    # start the main thread
+    mthread.start()
     # handle ctrl+c event
     signal.signal(signal.SIGINT, _sigint_handler)
     # create pcas server thread and shut down when app exits
-    if PV != '':
+    if server is not None:
         server_thread = ServerThread(server)
         # start pcas event loop
         server_thread.start()
     # Start the GUI thread
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())
@@ -0,0 +1,988 @@
+#! /usr/bin/env python
+"""
+Acquisition core of the bpc-monitor: polls the back pressure controllers, integrates the lHe
+used, writes the data files and serves the EPICS PVs and the email alerts.
+It does not depend on Qt, matplotlib or pandas so it also runs as a headless service:
+
+    python bpc-monitor.py --headless -C 172.30.33.212:20256,BPC1 -l C:\\_logcache_
+"""
+
+import sys, signal, inspect, json
+from os import sep, path, mkdir, replace, fsync
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from threading import Event, Thread
+from queue import Queue
+from datetime import datetime, timedelta
+from time import time, perf_counter
+from functools import partial
+from random import uniform
+# controller class
+import Vision130
+from RollingStats import RollingStats
+from DataWriter import DataWriter
+import bpc_store
+from numpy import NaN, Inf, isnan, float32, array, savez, load
+
+from pcaspy import SimpleServer, Driver
+from pcaspy.tools import ServerThread
+# for logging
+import logging
+from logging.handlers import TimedRotatingFileHandler
+
+from smtplib import SMTP
+from email.mime.text import MIMEText
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAIN_THREAD_POLL = 1000 # in ms (1 s), sampling period of the controllers
+MIN_THREAD_POLL = 50 # in ms, shortest sampling period that can be configured
+MAX_SAMPLE_GAP = 10000 # in ms, lHe is not integrated across longer gaps between valid samples
+REC_WINDOW = 60 # in min, averaging window of the lHe rate used for the time to threshold
+# EMAIL_POLL = 300000 # for testing
+EMAIL_POLL = 1.44e7 # in ms (4 hours)
+STATS_POLL = 600000 # in ms (10 min), interval of the controller link statistics
+CHECKPOINT_POLL = 60000 # in ms (1 min), interval of the integration state checkpoints
+WORKERS = 8
+FLUSH_INTERVAL = 1000 # in ms, the data files are written at least this often
+FLUSH_SIZE = 100 # lines, the data files are written once this many samples are queued
+WRITE_QUEUE = 100000 # samples queued for the data writer before new ones are dropped
+ARCHIVE = '.archive' # suffix of the stores back-filled from the daily files before they are spliced
+# float registers of the bpc that the monitor uses, only these are read from the controller
+BPC_REGISTERS = {'pressure': 20,
+                 'flow':     10,
+                 'valve':    23}
+
+pvdb = {
+        'PRESSURE':         {'prec'  : 3,
+                             'unit'  : 'mbar',
+                             'scan'  : 1},
+        'LHE_RECOVERED':    {'prec'  : 6,
+                             'unit'  : 'l/day',
+                             'scan'  : 1},
+        'VALVE':            {'prec'  : 0,
+                             'unit'  : '%',
+                             'scan'  : 1},
+        'HE_FLOW':          {'prec'  : 6,
+                             'unit'  : 'l/min',
+                             'scan'  : 1},
+        'LHE_LEFT':         {'prec'  : 3,
+                             'unit'  : 'l',
+                             'scan'  : 1},
+        'LHE_FIN':          {'prec'  : 2,
+                             'unit'  : 'day',
+                             'scan'  : 1},
+        'COMM_LATENCY':     {'prec'  : 1,
+                             'unit'  : 'ms',
+                             'scan'  : 1},
+        'COMM_ERRORS':      {'type'  : 'int',
+                             'scan'  : 1},
+        }
+
+class myDriver(Driver):
+
+    def __init__(self):
+       super(myDriver,self).__init__()
+
+class Controller:
+    """
+    Connection settings and lHe bookkeeping of one back pressure controller
+    """
+
+    def __init__(self, host, port, pv='', datadir='', correction=1.0, threshold='', \
+                 window=REC_WINDOW, period=MAIN_THREAD_POLL):
+        self.host = host
+        self.port = port
+        self.pv = pv
+        self.datadir = datadir
+        self.correction = correction
+        if pv != '' and not pv.endswith(':'):
+            self.prefix = pv + ':'
+        else:
+            self.prefix = pv
+        self.driver = None
+        # lHe start/threshold as entered by the user
+        self.start_lHe = ''
+        self.threshold_lHe = threshold
+        self.start_lHe_changed = 0
+        self.integrated_lHe_used = 0.0
+        self.remaining_lHe = NaN
+        self.calc_time_to_threshold = Inf
+        # rolling lHe rate in l/day over the last window minutes
+        self.rec = RollingStats(window*60, period*0.001)
+        # wall clock and monotonic time of the last acquisition
+        self.timestamp = datetime.now()
+        self.sample_time = NaN
+        # monotonic time and lHe rate of the last valid sample, the integration starts from it
+        self.last_valid_time = NaN
+        self.last_recovered = NaN
+        self.sample_gaps = 0
+        # link statistics of the last STATS_POLL interval
+        self.link_stats = None
+        # monotonic time of the last threshold email, NaN when the alert is armed
+        self.email_time = NaN
+        # remaining lHe written by versions before the checkpoints, only read
+        self.save_restore_fname = datadir + sep + 'bpc_save_restore' + '.sav'
+        self.checkpoint_fname = datadir + sep + 'bpc_checkpoint' + '.npz'
+
+    def __str__(self):
+        if self.pv != '':
+            return self.pv
+        return str(self.host) + ':' + str(self.port)
+
+    def data_fname(self, timestamp):
+        """
+        Daily data file the sample taken at timestamp goes to
+        """
+        return self.datadir + sep + 'bpc_log_' + timestamp.strftime("%Y%m%d") + '.txt'
+
+    def integration_time(self, recovered):
+        """
+        Returns the time in s and the mean lHe rate since the last valid sample,
+        the time is 0 for the first sample and after gaps longer than MAX_SAMPLE_GAP
+        """
+        dt = self.sample_time - self.last_valid_time
+        rate = recovered
+        if isnan(dt):
+            dt = 0.0
+        elif dt > MAX_SAMPLE_GAP*0.001:
+            self.sample_gaps += 1
+            logger.info(str(self) + " No valid sample for " + str(round(dt, 1)) + " s, lHe is not integrated across the gap")
+            dt = 0.0
+        else:
+            # trapezoid between the two samples
+            rate = 0.5*(self.last_recovered + recovered)
+        self.last_valid_time = self.sample_time
+        self.last_recovered = recovered
+        return dt, rate
+
+    def checkpoint_state(self,):
+        """
+        Snapshot of the integration state for write_checkpoint, taken in the polling thread.
+        Monotonic times are stored as wall clock times so they survive a restart
+        """
+        now = time()
+        offset = now - perf_counter()
+        times, values = self.rec.samples()
+        state = {'time': now,
+                 'start_lHe': self.start_lHe,
+                 'threshold_lHe': self.threshold_lHe,
+                 'integrated_lHe_used': self.integrated_lHe_used,
+                 'remaining_lHe': self.remaining_lHe,
+                 'last_valid_time': self.last_valid_time + offset,
+                 'last_recovered': self.last_recovered,
+                 'email_time': self.email_time + offset,
+                 'rec_ewma': self.rec.ewma}
+        return state, times + offset, values
+
+    def write_checkpoint(self, state, rec_times, rec_values):
+        """
+        Writes the checkpoint to a temporary file and renames it over the last one,
+        a crash leaves either the old or the new checkpoint
+        """
+        tmp = self.checkpoint_fname + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                savez(f, state=array(json.dumps(state)), rec_times=rec_times, rec_values=rec_values)
+                f.flush()
+                fsync(f.fileno())
+            replace(tmp, self.checkpoint_fname)
+        except Exception as e:
+            logger.info("In function: " +  inspect.stack()[0][3] + " " + str(self) + " Exception: " + str(e))
+
+    def load_checkpoint(self, expansion_ratio):
+        """
+        Restores the integration state of the last checkpoint and integrates the samples
+        logged after it. Returns False if there is no usable checkpoint
+        """
+        if not path.isfile(self.checkpoint_fname):
+            return False
+        try:
+            with load(self.checkpoint_fname) as z:
+                state = json.loads(str(z['state']))
+                rec_times = z['rec_times']
+                rec_values = z['rec_values']
+            # wall clock to monotonic time
+            offset = perf_counter() - time()
+            self.start_lHe = state['start_lHe']
+            # a threshold given on the command line wins
+            if self.threshold_lHe == '':
+                self.threshold_lHe = state['threshold_lHe']
+            self.integrated_lHe_used = state['integrated_lHe_used']
+            self.remaining_lHe = state['remaining_lHe']
+            self.last_valid_time = state['last_valid_time'] + offset
+            self.last_recovered = state['last_recovered']
+            self.email_time = state['email_time'] + offset
+            self.rec.load(rec_times + offset, rec_values, state['rec_ewma'])
+            n = self._backfill(state['time'], offset, expansion_ratio)
+        except Exception as e:
+            logger.info("In function: " +  inspect.stack()[0][3] + " " + str(self) + " Exception: " + str(e))
+            return False
+        logger.info(str(self) + " Restored the checkpoint of " + str(datetime.fromtimestamp(state['time'])) + \
+                    ", back-filled " + str(n) + " samples, lHe start [ltrs]: " + str(self.start_lHe) + \
+                    ", remaining [ltrs]: " + str(self.remaining_lHe))
+        return True
+
+    def _backfill(self, since, offset, expansion_ratio):
+        """
+        Integrates the samples of the data files taken after the wall clock time since,
+        returns their number
+        """
+        start_lHe = float(self.start_lHe) if isDigit(self.start_lHe) else 0.0
+        day = datetime.fromtimestamp(since).replace(hour=0, minute=0, second=0, microsecond=0)
+        n = 0
+        while day <= datetime.now():
+            fname = self.data_fname(day)
+            day = day + timedelta(days=1)
+            if bpc_store.day_file(fname) is None:
+                continue
+            with bpc_store.open_text(fname) as f:
+                for line in f:
+                    fields = line.split('\t')
+                    try:
+                        t = datetime.fromisoformat(fields[0]).timestamp()
+                        flow = float(fields[2])
+                    except (ValueError, IndexError):
+                        continue
+                    if t <= since or isnan(flow):
+                        continue
+                    # the logged flow is already corrected
+                    recovered = flow*60*24/(expansion_ratio)
+                    self.sample_time = t + offset
+                    self.rec.push(self.sample_time, recovered)
+                    dt, rate = self.integration_time(recovered)
+                    if start_lHe > 0:
+                        self.integrated_lHe_used = self.integrated_lHe_used + (rate/86400.0)*dt
+                    n += 1
+        if start_lHe > 0:
+            self.remaining_lHe = max(0, round((start_lHe - self.integrated_lHe_used), 4))
+        return n
+
+    def restore(self,):
+        """
+        Returns the remaining lHe saved by the last run or '' if there is none
+        """
+        try:
+            with open(self.save_restore_fname, 'r') as f:
+                restore_start_lHe = (f.read()).split(' ')[-1]
+                if (isDigit(restore_start_lHe)):
+                    return restore_start_lHe
+        except Exception as e:
+            logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+        return ''
+
+class Sample:
+    """
+    One reading of a controller and the values derived from it, immutable.
+    The poller publishes exactly one per controller and cycle.
+    flow is the He flow with the correction factor applied
+    """
+    __slots__ = ('ctrl', 'timestamp', 'sample_time', 'pressure', 'flow', 'valve', \
+                 'recovered', 'remaining_lHe', 'time_to_threshold')
+
+    def __init__(self, ctrl, timestamp, sample_time, pressure, flow, valve, \
+                 recovered=NaN, remaining_lHe=NaN, time_to_threshold=Inf):
+        values = (ctrl, timestamp, float(sample_time), float(pressure), float(flow), float(valve), \
+                  float(recovered), float(remaining_lHe), float(time_to_threshold))
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Sample is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Sample is immutable")
+
+    def __repr__(self):
+        return 'Sample(' + str(self.ctrl) + ', ' + str(self.timestamp) + ', P=' + str(self.pressure) + \
+               ', flow=' + str(self.flow) + ', valve=' + str(self.valve) + ')'
+
+    def valid(self,):
+        """
+        True if the controller returned at least one value
+        """
+        return not (isnan(self.pressure) and isnan(self.flow) and isnan(self.valve))
+
+    def line(self,):
+        """
+        Line of the daily data file: date, pressure, flow and valve separated by tabs
+        """
+        # the registers are float32, their shortest repr keeps every digit the controller sent
+        return str(self.timestamp) + '\t' + str(float32(self.pressure)) + '\t' + str(float32(self.flow)) + \
+               '\t' + str(float32(self.valve)) + '\n'
+
+def send_email(receiver, remaining_lHe):
+    resource = "smtp.nist.gov"
+    port = 25
+    sender = "alireza.panna@nist.gov"
+    subject = "LHe at threshold"
+    body = """ <html>
+               <head></head>
+               <body>
+               <p>Hello user,<br>
+                  The LHe level in your dewar is below the set threshold level.<br>
+                  Remaining lHe in your dewar: """ + str(round(remaining_lHe, 3)) + """ ltrs
+                 <br>Please re-fill or exchange dewar.<br><br>
+                  Thank you<br><br>
+                  Best,<br>
+                  Your friendly service galley lHe monitor
+               </p>
+               </body>
+               </html> """
+    msg = MIMEText(body, "html")
+    msg["From"] = sender
+    msg["Subject"] = subject
+    msg["To"] = ", ".join(receiver)
+    try:
+        smtp_server = SMTP(resource, port)
+        try:
+            smtp_server.sendmail(sender, receiver, msg.as_string())
+        finally:
+            smtp_server.quit()
+    except Exception as e:
+        logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+
+class Poller:
+    """
+    Polls all controllers on a fixed grid of monotonic deadlines, integrates the lHe they
+    used and publishes every sample to the data writer, the pcas driver and the email alert.
+    on_sample(sample) and on_link_stats(ctrl, snap) are called from
+    the polling thread after a sample or the link statistics were published.
+    """
+
+    def __init__(self, controllers, period=MAIN_THREAD_POLL, expansion_ratio=754.2, \
+                 receiver=[''], drv=None, simulate=False, debug_log=False, writer=None, \
+                 checkpoint_interval=CHECKPOINT_POLL):
+        self.controllers = controllers
+        self.period = period
+        self.expansion_ratio = expansion_ratio
+        self.receiver = receiver
+        self.drv = drv
+        self.writer = writer
+        self.checkpoint_interval = checkpoint_interval
+        self.simulate = simulate
+        self.debug_log = debug_log
+        self.on_sample = None
+        self.on_link_stats = None
+        # all controllers are polled at the same time, a slow or dead PLC does not delay the others
+        self.pool = ThreadPoolExecutor(max_workers=max(1, min(len(controllers), WORKERS)))
+        # reads still running, at most one per controller
+        self.pending = {}
+        self.stalled_reads = 0
+        self.regset = Vision130.RegisterSet(BPC_REGISTERS)
+        self._kill = False
+        self._stop_event = Event()
+        self.missed_deadlines = 0
+        self.max_lateness = 0.0
+        self.stats_time = perf_counter()
+        self.checkpoint_time = perf_counter()
+
+    def _acquire(self, ctrl):
+        """
+        Reads one controller and timestamps the sample when the read was issued
+        """
+        timestamp = datetime.now()
+        sample_time = perf_counter()
+        return timestamp, sample_time, self._getRbvs(ctrl)
+
+    def _getRbvs(self, ctrl):
+        #logger.info("In function: " + inspect.stack()[0][3])
+        if self.simulate:
+            debug_bpc_rbv = {'pressure': uniform(24.5, 25.5),
+                             'flow':     uniform (0, 5),
+                             'valve':    uniform(0,100)}
+            return debug_bpc_rbv
+        else:
+            try:
+                # get the float registers we use from the controller
+                bpc_rbv = self.regset.as_dict(ctrl.driver.read_registers(self.regset))
+                return bpc_rbv
+            except Exception as e:
+                logger.info("In function: " + inspect.stack()[0][3] + ' ' + str(e))
+                return dict.fromkeys(BPC_REGISTERS, NaN)
+
+    def _update(self, ctrl, all_rbv):
+        """
+        Integrates the lHe used by one controller and publishes the sample
+        """
+        recovered = NaN
+        dt, rate = 0.0, NaN
+        try:
+            if not (isnan(all_rbv['flow'])):
+                recovered = (ctrl.correction*all_rbv['flow'])*60*24/(self.expansion_ratio)
+                ctrl.rec.push(ctrl.sample_time, recovered)
+                dt, rate = ctrl.integration_time(recovered)
+            else:
+                recovered = NaN
+            # if user enters lHe start ltrs...
+            if ctrl.start_lHe != '':
+                # get the starting lHe from user
+                start_lHe = float(ctrl.start_lHe)
+                if start_lHe > 0:
+                    if not (isnan(recovered)):
+                        try:
+                            if ctrl.start_lHe_changed:
+                                ctrl.integrated_lHe_used = 0
+                                ctrl.start_lHe_changed = 0
+                                # a new dewar re-arms the threshold email
+                                ctrl.email_time = NaN
+                            # lHe used since the last valid sample in litres
+                            inst_lHe_used = (rate/86400.0)*dt
+                            # integrated lHe being used in liters
+                            if not isnan(inst_lHe_used):
+                                ctrl.integrated_lHe_used = ctrl.integrated_lHe_used + inst_lHe_used
+                            # remaining_lHe used in litres
+                                ctrl.remaining_lHe = round((start_lHe - ctrl.integrated_lHe_used), 4)
+                            if float(ctrl.remaining_lHe) <= 0:
+                                ctrl.remaining_lHe = 0
+                        except Exception as e:
+                            logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+                            pass
+                        if ctrl.threshold_lHe != '' and float(ctrl.threshold_lHe) < start_lHe and ctrl.rec.mean != 0:
+                            start_lHe_threshold_corr = start_lHe - float(ctrl.threshold_lHe)
+                            ctrl.calc_time_to_threshold = round(((start_lHe_threshold_corr - ctrl.integrated_lHe_used)/ctrl.rec.mean), 2)
+                        else:
+                            ctrl.calc_time_to_threshold = Inf
+                else:
+                    # start lHe <=0
+                    ctrl.remaining_lHe = NaN
+                    ctrl.calc_time_to_threshold = Inf
+                    ctrl.integrated_lHe_used = 0
+            else:
+                # if start ltr text == ''
+                ctrl.remaining_lHe = NaN
+                ctrl.calc_time_to_threshold = Inf
+                ctrl.integrated_lHe_used = 0
+        except Exception as e:
+            ctrl.remaining_lHe = NaN
+            logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+        self._publish(Sample(ctrl, ctrl.timestamp, ctrl.sample_time, all_rbv['pressure'], \
+                             all_rbv['flow']*ctrl.correction, all_rbv['valve'], recovered, \
+                             ctrl.remaining_lHe, ctrl.calc_time_to_threshold))
+        if self.debug_log:
+            logger.info(str(ctrl) + " Remaining lHe: " + str(ctrl.remaining_lHe))
+
+    def _publish(self, sample):
+        """
+        Queues one sample for the data files, writes the pcas records and checks the email alert
+        """
+        ctrl = sample.ctrl
+        if self.writer is not None:
+            self.writer.put(sample)
+        if self.drv is not None and ctrl.pv != '':
+            self.drv.write(ctrl.prefix + 'PRESSURE', sample.pressure)
+            self.drv.write(ctrl.prefix + 'VALVE', sample.valve)
+            self.drv.write(ctrl.prefix + 'HE_FLOW', sample.flow)
+            self.drv.write(ctrl.prefix + 'LHE_RECOVERED', sample.recovered)
+            self.drv.write(ctrl.prefix + 'LHE_LEFT', sample.remaining_lHe)
+            self.drv.write(ctrl.prefix + 'LHE_FIN', sample.time_to_threshold)
+            self.drv.updatePVs()
+        self._check_threshold(ctrl)
+        if self.on_sample is not None:
+            self.on_sample(sample)
+
+    def _check_threshold(self, ctrl):
+        """
+        Emails the receivers when the remaining lHe drops to the threshold and then every EMAIL_POLL
+        """
+        if ctrl.threshold_lHe == '' or isnan(ctrl.remaining_lHe) or self.receiver == ['']:
+            return
+        try:
+            if ctrl.remaining_lHe > float(ctrl.threshold_lHe):
+                # refilled or threshold lowered, re-arm
+                ctrl.email_time = NaN
+                return
+        except ValueError:
+            return
+        if isnan(ctrl.email_time) or perf_counter() - ctrl.email_time >= EMAIL_POLL*0.001:
+            ctrl.email_time = perf_counter()
+            logger.info(str(ctrl) + " lHe at threshold, emailing " + str(self.receiver))
+            # the smtp server can be slow, do not hold up the sampling
+            Thread(target=send_email, args=(self.receiver, ctrl.remaining_lHe), daemon=True).start()
+
+    def run(self):
+        """
+        Polling loop
+        - polls all controllers concurrently and publishes each sample when its read finishes
+        - The controllers are sampled on a fixed grid of monotonic deadlines every
+          period ms, the time spent polling does not add to the period.
+          Deadlines that are missed because a cycle overran are skipped and counted.
+        - A controller whose read is still running at the deadline is not read again until
+          it finishes, the other controllers keep their deadlines.
+        """
+        period = self.period*0.001
+        deadline = perf_counter()
+        while 1 and not self._kill:
+            #logger.info("In function: " + inspect.stack()[0][3])
+            deadline = deadline + period
+            stalled = self._poll(deadline)
+            if perf_counter() - self.stats_time >= STATS_POLL*0.001:
+                self.stats_time = perf_counter()
+                self._link_stats()
+            if perf_counter() - self.checkpoint_time >= self.checkpoint_interval*0.001:
+                self.checkpoint_time = perf_counter()
+                self.checkpoint()
+            late = perf_counter() - deadline
+            # a cycle that waited for a stalled controller ends at its deadline, it did not overrun
+            if late > 0 and (not stalled or late >= period):
+                # skip the deadlines we missed instead of sampling in a burst to catch up
+                missed = int(late/period) + 1
+                self.missed_deadlines += missed
+                self.max_lateness = max(self.max_lateness, late)
+                deadline = deadline + missed*period
+                if self.debug_log:
+                    logger.info("Polling overran by " + str(round(late*1000, 1)) + " ms, skipped " + str(missed) + " sample(s)")
+            self._stop_event.wait(max(0.0, deadline - perf_counter()))
+        self.checkpoint()
+
+    def _poll(self, deadline):
+        """
+        Starts a read of every controller that is not still being read and publishes each sample
+        as soon as its read finishes, up to the deadline. Returns the controllers whose read did
+        not finish in time, their sample is published by a later cycle when it does
+        """
+        for ctrl in self.controllers:
+            if ctrl not in self.pending:
+                try:
+                    self.pending[ctrl] = self.pool.submit(self._acquire, ctrl)
+                except RuntimeError:
+                    # the pool was shut down by stop()
+                    return []
+        futures = {future: ctrl for ctrl, future in self.pending.items()}
+        try:
+            for future in as_completed(futures, timeout=max(0.0, deadline - perf_counter())):
+                ctrl = futures[future]
+                del self.pending[ctrl]
+                try:
+                    timestamp, sample_time, all_rbv = future.result()
+                except Exception as e:
+                    timestamp, sample_time, all_rbv = datetime.now(), perf_counter(), dict.fromkeys(BPC_REGISTERS, NaN)
+                    logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+                ctrl.timestamp = timestamp
+                ctrl.sample_time = sample_time
+                self._update(ctrl, all_rbv)
+        except FuturesTimeout:
+            pass
+        stalled = list(self.pending)
+        self.stalled_reads += len(stalled)
+        if stalled and self.debug_log:
+            logger.info("Reads still running at the deadline: " + ", ".join(str(ctrl) for ctrl in stalled))
+        return stalled
+
+    def checkpoint(self,):
+        """
+        Snapshots the state of every controller, the data writer writes the checkpoints
+        after the samples queued before them
+        """
+        for ctrl in self.controllers:
+            job = partial(ctrl.write_checkpoint, *ctrl.checkpoint_state())
+            if self.writer is not None:
+                self.writer.put_job(job)
+            else:
+                job()
+
+    def _link_stats(self,):
+        """
+        Takes the link statistics of every controller for the last interval and logs them
+        """
+        if self.stalled_reads > 0:
+            logger.info("Controller reads still running at " + str(self.stalled_reads) + " sampling deadline(s)")
+            self.stalled_reads = 0
+        if self.missed_deadlines > 0:
+            logger.info("Polling missed " + str(self.missed_deadlines) + " sampling deadline(s), latest by " + \
+                        str(round(self.max_lateness*1000, 1)) + " ms")
+            self.missed_deadlines = 0
+            self.max_lateness = 0.0
+        if self.writer is not None:
+            w = self.writer.snapshot(reset=True)
+            logger.info("Data writer: lines=" + str(w['lines']) + \
+                        ', flushes=' + str(w['flushes']) + \
+                        ', dropped=' + str(w['dropped']) + \
+                        ', late=' + str(w['late']) + \
+                        ', jobs=' + str(w['jobs']) + \
+                        ', backlog=' + str(w['backlog']) + \
+                        ', max backlog=' + str(w['max_backlog']) + \
+                        ', flush mean=' + str(round(w['flush_mean_ms'], 1)) + \
+                        ' ms max=' + str(round(w['flush_max_ms'], 1)) + ' ms')
+        for ctrl in self.controllers:
+            if ctrl.driver is None:
+                continue
+            snap = ctrl.driver.stats.snapshot(reset=True)
+            ctrl.link_stats = snap
+            latency = ''
+            for command, c in snap['commands'].items():
+                latency = latency + ', ' + command + ': n=' + str(c['count']) + ' mean=' + str(round(c['mean_ms'], 1)) + \
+                          ' ms p50=' + str(round(c['p50_ms'], 1)) + ' ms p99=' + str(round(c['p99_ms'], 1)) + ' ms max=' + str(round(c['max_ms'], 1)) + ' ms'
+            logger.info(str(ctrl) + " Link statistics: timeouts=" + str(snap['timeouts']) + \
+                        ', short frames=' + str(snap['short_frames']) + \
+                        ', checksum errors=' + str(snap['checksum_errors']) + \
+                        ', stale frames=' + str(snap['stale_frames']) + \
+                        ', reconnects=' + str(snap['reconnects']) + \
+                        ', connect failures=' + str(snap['connect_failures']) + \
+                        ', reads while link down=' + str(snap['link_down_reads']) + latency)
+            if self.drv is not None and ctrl.pv != '':
+                # the binary dialect reads the floats with its own command code
+                rnf = snap['commands'].get('RNF', snap['commands'].get('BIN%02X' % Vision130.BIN_READ_OPERANDS))
+                self.drv.write(ctrl.prefix + 'COMM_LATENCY', rnf['p99_ms'] if rnf is not None else NaN)
+                self.drv.write(ctrl.prefix + 'COMM_ERRORS', snap['errors'])
+                self.drv.updatePVs()
+            if self.on_link_stats is not None:
+                self.on_link_stats(ctrl, snap)
+
+    def stop(self):
+        """
+        Stops the polling loop, it returns after the current cycle
+        """
+        self._kill = True
+        self._stop_event.set()
+        self.pool.shutdown(wait=False)
+
+def isDigit(x):
+    try:
+        float(x)
+        return True
+    except ValueError:
+        return False
+
+def dir_path(save_path):
+    save_path = str(save_path)
+    if not path.isdir(save_path):
+        mkdir(save_path)
+    return save_path
+
+def range_limited_float_type(arg):
+    """
+    Type function for argparse - a float within some predefined bounds
+    """
+    MIN_VAL = 1
+    MAX_VAL = 2
+    try:
+        f = float(arg)
+    except ValueError:
+        raise ArgumentTypeError("Must be a floating point number")
+    if f < MIN_VAL or f > MAX_VAL:
+        raise ArgumentTypeError("Argument must be <= " + str(MAX_VAL) + " and >= " + str(MIN_VAL))
+    return f
+
+def poll_period_type(arg):
+    """
+    Type function for argparse - the sampling period in ms
+    """
+    try:
+        f = float(arg)
+    except ValueError:
+        raise ArgumentTypeError("Must be a floating point number")
+    if f < MIN_THREAD_POLL:
+        raise ArgumentTypeError("Argument must be >= " + str(MIN_THREAD_POLL))
+    return f
+
+def controller_type(arg):
+    """
+    Type function for argparse - a controller given as host:port[,pv[,save_path[,correction]]]
+    """
+    fields = [x.strip() for x in arg.split(',')]
+    if len(fields) > 4 or ':' not in fields[0]:
+        raise ArgumentTypeError("Controller must be given as host:port[,pv[,save_path[,correction]]]")
+    host, port = fields[0].rsplit(':', 1)
+    try:
+        port = int(port)
+    except ValueError:
+        raise ArgumentTypeError("Port must be an integer")
+    fields = fields + [''] * (4 - len(fields))
+    if fields[3] != '':
+        fields[3] = range_limited_float_type(fields[3])
+    return {'host': host, 'port': port, 'pv': fields[1], 'save_path': fields[2], 'correction': fields[3]}
+
+def arg_parser():
+    """
+    Command line options shared by the GUI and the headless service
+    """
+    # user options to run multiple instances with different configurations for example
+    parser = ArgumentParser(prog = 'bpc-monitor',
+                            description='Configure bpc-monitor.',
+                            epilog='A utility to log data and estimate lHe usage from the back pressure controller', add_help=True)
+    parser.add_argument('-i', '--host', help='specify the host address', default='172.30.33.212')
+    parser.add_argument('-p', '--port',  help='specify the port', default='20256', type=int)
+    parser.add_argument('-e', '--epics_pv',  help='Specify the PV epics prefix', default='')
+    parser.add_argument('-s', '--save_path', help='Specify data directory', default="C:" + sep + "_datacache_", type=dir_path)
+    parser.add_argument('-l', '--log_path', help='Specify log directory', default="C:" + sep + "_logcache_", type=dir_path)
+    parser.add_argument('-d', '--debug', help='Debugging mode', action='store_true')
+    parser.add_argument('-dl', '--debug_log', help='Save all debugging logs', action='store_true')
+    parser.add_argument('-t', '--threshold',  help='Specify lHe threshold in ltrs', default='', type=str)
+    parser.add_argument('-c', '--correction',  help='Specify correction factor between 1.0 and 2.0', default='1.0', type=range_limited_float_type)
+    parser.add_argument('-rv','--expansion_ratio', help='Specify the helium gas to liquid expansion ratio', default=754.2, type=float)
+    parser.add_argument('-m', '--mail', help='Specify receipients email address', default='')
+    parser.add_argument('-C', '--controller', help='Add a controller as host:port[,pv[,save_path[,correction]]], ' + \
+                        'can be repeated to monitor several controllers from one process. ' + \
+                        'Omitted fields default to -e, -s/<pv or host> and -c', action='append', default=[], type=controller_type)
+    parser.add_argument('-r', '--rate', help='Specify the sampling period in ms, e.g. 100 samples at 10 Hz', default=MAIN_THREAD_POLL, type=poll_period_type)
+    parser.add_argument('-w', '--window', help='Specify the averaging window of the lHe rate in minutes', default=REC_WINDOW, type=float)
+    parser.add_argument('--pcom', help='PCOM dialect used to read the float registers, binary reads all of them in one frame', default='ascii', choices=['ascii', 'binary'])
+    parser.add_argument('--flush_interval', help='Specify how often the data files are written in ms', default=FLUSH_INTERVAL, type=float)
+    parser.add_argument('--flush_size', help='Specify after how many samples the data files are written', default=FLUSH_SIZE, type=int)
+    parser.add_argument('--columnar', help='Also store every finished day column wise as .npz next to its text file, ' + \
+                        'the history loads those instead of parsing the text', action='store_true')
+    parser.add_argument('--binlog', help='Also append every sample to the binary log bpc_log.bin of fixed size ' + \
+                        'records, the history reads its ranges memory mapped instead of parsing the text', action='store_true')
+    parser.add_argument('--rollup', help='Keep 1 min, 1 h and 1 day aggregates of the samples, the history ' + \
+                        'is served from the coarsest that fits the binning', action='store_true')
+    parser.add_argument('--compress', help='Compress every finished day to .txt.gz, the history reads ' + \
+                        'both', action='store_true')
+    parser.add_argument('--sqlite', help='Also insert every sample with its lHe rec. and remaining lHe into ' + \
+                        'the sqlite database bpc_log.sqlite, the history is aggregated by sqlite', action='store_true')
+    parser.add_argument('--cache_size', help='Specify the memory budget of the parsed history files in MB', \
+                        default=512, type=float)
+    parser.add_argument('--cache_dir', help='Directory the parsed history files are also cached in so they ' + \
+                        'survive restarts, off by default', default='', type=str)
+    parser.add_argument('--cache_dir_size', help='Specify the disk budget of the cache directory in MB', \
+                        default=2048, type=float)
+    parser.add_argument('--cache_warm', help='Specify how many past days are parsed into the cache at startup', \
+                        default=7, type=int)
+    parser.add_argument('--checkpoint', help='Specify how often the lHe integration state is saved in ms', default=CHECKPOINT_POLL, type=float)
+    parser.add_argument('--headless', help='Run without the GUI as a service: acquisition, data files, pcas server and email only', action='store_true')
+    parser.add_argument('--start', help='Specify the lHe start in ltrs for --headless, defaults to the state of the last run', default='', type=str)
+    return parser
+
+def make_controllers(args):
+    """
+    Controllers given by the parsed command line options
+    """
+    correction = args.correction
+    if correction == '':
+        correction = 1.0
+    controllers = []
+    if args.controller == []:
+        controllers.append(Controller(args.host, args.port, args.epics_pv, args.save_path, correction, \
+                                      args.threshold, args.window, args.rate))
+    for c in args.controller:
+        pv = c['pv'] if c['pv'] != '' else args.epics_pv
+        if c['save_path'] != '':
+            save_path = dir_path(c['save_path'])
+        elif len(args.controller) > 1:
+            # keep the data files of the controllers apart
+            save_path = dir_path(args.save_path + sep + (pv.rstrip(':') if pv != '' else c['host']))
+        else:
+            save_path = args.save_path
+        controllers.append(Controller(c['host'], c['port'], pv, save_path, \
+                                      c['correction'] if c['correction'] != '' else correction, \
+                                      args.threshold, args.window, args.rate))
+    return controllers
+
+def start_logging(args, controllers):
+    """
+    Logs to a file in the log directory that rolls over at midnight, returns the handler
+    """
+    # define the file handler and formatting
+    lfname = args.log_path + sep + 'bpc-monitor' + '.log'
+    file_handler = TimedRotatingFileHandler(lfname, when='midnight')
+    fmt = logging.Formatter('%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    file_handler.setFormatter(fmt)
+    # the gui and the core log through their own loggers, both end up in the file
+    logging.getLogger().addHandler(file_handler)
+    for ctrl in controllers:
+        logger.info('Starting the bpc-monitor with the following settings: ' + \
+                    'Server: ' + str(ctrl.host) + \
+                    ', Port: ' +  str(ctrl.port) + \
+                    ', PCOM: ' + args.pcom + \
+                    ', Sampling period [ms]: ' + str(args.rate) + \
+                    ', lHe rate window [min]: ' + str(args.window) + \
+                    ', PV: ' +  str(ctrl.pv) + \
+                    ', Datadir: ' + str(ctrl.datadir) + \
+                    ', Logdir: ' + str(args.log_path) + \
+                    ', Receiver: ' + str(args.mail.split(';')) + \
+                    ', Debug mode: ' + str(args.debug) + \
+                    ', Save debug log: ' + str(args.debug_log) + \
+                    ', Headless: ' + str(args.headless) + \
+                    ', Threshold: ' + args.threshold + \
+                    ', Correction Factor: ' + str(ctrl.correction) + \
+                    ', Helium Expansion Ratio: ' + str(args.expansion_ratio))
+    return file_handler
+
+def start_pcas(controllers):
+    """
+    Creates one pcas server for all controllers, the record names carry the prefix of their controller.
+    Returns the server and its driver or (None, None) if no controller has a PV
+    """
+    ca_pvdb = {}
+    for ctrl in controllers:
+        if ctrl.pv != '':
+            for name, record in pvdb.items():
+                ca_pvdb[ctrl.prefix + name] = record
+    if ca_pvdb == {}:
+        return None, None
+    server = SimpleServer()
+    server.createPV('', ca_pvdb)
+    return server, myDriver()
+
+class Maintenance(Thread):
+    """
+    Runs the jobs on the archives of the data directories one after the other in the background,
+    e.g. indexing and compressing the past days, so the data writer only writes samples. The jobs
+    are not persisted, the ones that did not run are queued again by the next start
+    """
+
+    def __init__(self,):
+        Thread.__init__(self, name='Maintenance', daemon=True)
+        self.queue = Queue()
+
+    def put_job(self, job):
+        """
+        Queues a callable, never blocks
+        """
+        self.queue.put(job)
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                job()
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " Exception: " + str(e))
+
+def _archive_day(columnar, compress, ctrl, fname):
+    """
+    Runs in the maintenance thread after the file of a past day was closed
+    """
+    if columnar:
+        bpc_store.txt_to_npz(fname)
+    if compress:
+        bpc_store.compress_txt(fname)
+    bpc_store.update_manifest(ctrl.datadir, fname)
+
+def _day_closed(maintenance, columnar, compress, ctrl, fname):
+    """
+    Called by the writer thread after the file of a past day was closed
+    """
+    maintenance.put_job(partial(_archive_day, columnar, compress, ctrl, fname))
+
+def _splice(writer, store, datadir, start, archive, result, done):
+    """
+    Runs in the writer thread, see DataWriter.splice()
+    """
+    try:
+        writer.splice(store, datadir, start, archive)
+        result.append(True)
+    finally:
+        done.set()
+
+def _backfill_store(writer, store, datadir, start, expansion_ratio):
+    """
+    Runs in the maintenance thread: fills the store of the data directory with the samples of the
+    daily files taken before start, ns since the epoch, while the writer appends the samples after it
+    """
+    t0 = perf_counter()
+    if store == 'sqlite':
+        # sqlite takes the rows before start beside the writer, nothing to splice
+        n = bpc_store.backfill_sqlite(datadir, start, expansion_ratio)
+    else:
+        if store == 'binlog':
+            archive = bpc_store.binlog_name(datadir) + ARCHIVE
+            n = bpc_store.build_binlog(datadir, start, archive)
+        else:
+            # the suffix of the tier files
+            archive = ARCHIVE
+            n = bpc_store.build_rollups(datadir, start, archive)
+        result, done = [], Event()
+        writer.put_job(partial(_splice, writer, store, datadir, start, archive, result, done))
+        while not done.wait(1.0):
+            if not writer.is_alive():
+                return
+        if result == []:
+            logger.info("The " + store + " of " + str(datadir) + " was not back-filled, the history reads the daily files " + \
+                        "until a restart back-fills it")
+            return
+    bpc_store.set_store_complete(datadir, store, True)
+    logger.info("Back-filled the " + store + " of " + str(datadir) + " with " + str(n) + " samples in " + \
+                str(round(perf_counter() - t0, 1)) + " s")
+
+def start_writer(args, controllers):
+    """
+    Starts the thread writing the data files of all controllers and the maintenance thread. Every
+    closed day is added to the manifest of its data directory, with --columnar stored column wise and
+    with --compress compressed by the maintenance thread. The archive is indexed and compressed by it
+    on the first start, the binary log, the rollups and the sqlite database are back-filled from it
+    """
+    writer = DataWriter(WRITE_QUEUE, args.flush_interval, args.flush_size, args.binlog, args.rollup, args.sqlite)
+    # the samples from now on are appended by the writer
+    start = bpc_store.to_ns(datetime.now())
+    maintenance = Maintenance()
+    writer.on_day_closed = partial(_day_closed, maintenance, args.columnar, args.compress)
+    # the day that ended while we were not running
+    yesterday = datetime.now() - timedelta(days=1)
+    for ctrl in controllers:
+        fname = ctrl.data_fname(yesterday)
+        if args.columnar and bpc_store.day_file(fname) is not None and not bpc_store.has_npz(fname):
+            maintenance.put_job(partial(bpc_store.txt_to_npz, fname))
+        if args.compress:
+            today = path.basename(ctrl.data_fname(datetime.now()))
+            for name in bpc_store.daily_files(ctrl.datadir):
+                if name != today and path.isfile(ctrl.datadir + sep + name):
+                    maintenance.put_job(partial(bpc_store.compress_txt, ctrl.datadir + sep + name))
+        manifest = bpc_store.Manifest(ctrl.datadir)
+        if not manifest.load():
+            maintenance.put_job(manifest.rebuild)
+        elif bpc_store.day_file(fname) is not None and path.basename(fname) not in [e['name'] for e in manifest.entries]:
+            maintenance.put_job(partial(bpc_store.update_manifest, ctrl.datadir, fname))
+        for store, enabled in (('binlog', args.binlog), ('rollup', args.rollup), ('sqlite', args.sqlite)):
+            if enabled and bpc_store.needs_backfill(ctrl.datadir, store):
+                # the history reads the daily files until the back-fill is done
+                bpc_store.set_store_complete(ctrl.datadir, store, False)
+                maintenance.put_job(partial(_backfill_store, writer, store, ctrl.datadir, start, args.expansion_ratio))
+    writer.start()
+    maintenance.start()
+    return writer
+
+def main(argv=None):
+    """
+    Headless service: polls the controllers in the main thread until SIGINT/SIGTERM
+    """
+    args, unk = arg_parser().parse_known_args(argv)
+    controllers = make_controllers(args)
+    file_handler = start_logging(args, controllers)
+    if unk:
+        logger.info("Warning: Ignoring unknown arguments: {:}".format(unk))
+    for ctrl in controllers:
+        if args.start != '':
+            ctrl.start_lHe = args.start
+            ctrl.start_lHe_changed = 1
+        elif not ctrl.load_checkpoint(args.expansion_ratio):
+            # no checkpoint yet, continue from the remaining lHe of the last run
+            ctrl.start_lHe = ctrl.restore()
+            ctrl.start_lHe_changed = 1
+        logger.info(str(ctrl) + " lHe start [ltrs]: " + str(ctrl.start_lHe))
+    server, drv = start_pcas(controllers)
+    if not args.debug:
+        for ctrl in controllers:
+            ctrl.driver = Vision130.Vision130Driver(ctrl.host, ctrl.port, mode=args.pcom)
+    writer = start_writer(args, controllers)
+    poller = Poller(controllers, args.rate, args.expansion_ratio, args.mail.split(';'), drv, \
+                    simulate=args.debug, debug_log=args.debug_log, writer=writer, \
+                    checkpoint_interval=args.checkpoint)
+    server_thread = None
+    if server is not None:
+        server_thread = ServerThread(server)
+        # start pcas event loop
+        server_thread.start()
+
+    def _stop(*args):
+        poller.stop()
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        poller.run()
+    finally:
+        writer.stop()
+        for ctrl in controllers:
+            if ctrl.driver is not None:
+                ctrl.driver.close_comm()
+        if server_thread is not None:
+            server_thread.stop()
+        logger.info("Stopped the headless bpc-monitor")
+        file_handler.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,329 @@
+#! /usr/bin/env python
+"""
+Reading of the daily data files for the history plots and sums. Free of Qt so the
+files can be parsed in the worker processes of a process pool. The parsed past days are
+kept in the process wide CACHE, see configure_cache(), today's file is read incrementally
+by TAIL.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+from io import BytesIO
+from os import path, stat, makedirs, replace, listdir, remove, utime
+from threading import Lock
+from numpy import savez, load, int64, array
+from pandas import read_csv, to_datetime, DataFrame, concat
+import bpc_store
+
+HEADERS = ['Date', 'Pressure', 'Flow', 'Valve']
+# default memory budget of the parsed file cache in MB
+CACHE_SIZE = 512
+# default disk budget of the spill directory in MB
+CACHE_DIR_SIZE = 2048
+# chunks of a tailed file that are merged into one frame
+TAIL_CHUNKS = 64
+
+def parse_lines(f, memory_map=False):
+    """
+    Parses the lines of a data file from the file or buffer f, returns the dataframe with
+    the dates parsed. Lines with a bad date are dropped like the lines read_csv skips
+    """
+    df = read_csv(f, sep='\t', dtype={0:"str", 1: "float16", 2:"float16", 3:"float16"}, \
+                  on_bad_lines='skip', na_filter=True, index_col=False, memory_map=memory_map, \
+                  low_memory=True, compression='infer', \
+                  usecols=[0,1,2,3], engine='c', names=HEADERS, na_values='nan')
+    df['Date'] = to_datetime(df['Date'], format="ISO8601", errors='coerce')
+    return df.dropna(subset=['Date'])
+
+def read_day(filename):
+    """
+    Returns ([dataframe], error) of one daily file with the dates already parsed, the columnar
+    file of the day is loaded instead of its text file if it is up to date. On an error the
+    list is empty and error holds the message
+    """
+    mydata = []
+    try:
+        if bpc_store.has_npz(filename):
+            columns = bpc_store.read_npz(bpc_store.npz_name(filename))
+            mydata.append(DataFrame({'Date': to_datetime(columns['time']), 'Pressure': columns['pressure'], \
+                                     'Flow': columns['flow'], 'Valve': columns['valve']}))
+            return mydata, None
+        # a closed day may be compressed
+        if bpc_store.day_file(filename) is None:
+            raise FileNotFoundError("No such file: " + str(filename))
+        filename = bpc_store.day_file(filename)
+        mydata.append(parse_lines(filename, memory_map=not filename.endswith(bpc_store.GZ)))
+    except Exception as e:
+        return [], str(e)
+    return mydata, None
+
+class FileCache:
+    """
+    Parsed daily files keyed by (path, size, mtime) so a file that changed is parsed again.
+    The least recently used files are evicted beyond budget bytes. With a spill directory
+    every parsed file is also stored there and is loaded from it after a restart, the least
+    recently used spill files are removed beyond spill_budget bytes
+    """
+
+    def __init__(self, budget=CACHE_SIZE*2**20, spill_dir='', spill_budget=CACHE_DIR_SIZE*2**20):
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.spill_budget = spill_budget
+        self.frames = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        # spill file: bytes, least recently used first, None until the spill directory was scanned
+        self.spilled = None
+        self.spill_size = 0
+        self.spill_lock = Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, filename):
+        """
+        Cache key of a daily file or None if it does not exist
+        """
+        fname = bpc_store.day_file(filename)
+        if fname is None:
+            return None
+        st = stat(fname)
+        return (path.abspath(fname), st.st_size, st.st_mtime)
+
+    def _spill_name(self, key):
+        return path.join(self.spill_dir, sha1(repr(key).encode('utf-8')).hexdigest() + '.npz')
+
+    def get(self, key):
+        """
+        Parsed data of the key or None
+        """
+        with self.lock:
+            df = self.frames.get(key)
+            if df is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return df
+        fname = self._spill_name(key) if self.spill_dir != '' else None
+        if fname is not None and self._touch_spill(fname):
+            try:
+                with load(fname) as z:
+                    df = DataFrame({'Date': to_datetime(z['Date']), 'Pressure': z['Pressure'], \
+                                    'Flow': z['Flow'], 'Valve': z['Valve']})
+                # the order of use survives a restart
+                utime(fname)
+                self._add(key, df)
+                with self.lock:
+                    self.disk_hits += 1
+                return df
+            except Exception:
+                pass
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, df):
+        """
+        Caches the parsed data of the key and spills it to the cache directory
+        """
+        self._add(key, df)
+        if self.spill_dir != '':
+            makedirs(self.spill_dir, exist_ok=True)
+            fname = self._spill_name(key)
+            tmp = fname + '.tmp'
+            with open(tmp, 'wb') as f:
+                savez(f, Date=df['Date'].values.astype(int64), Pressure=df['Pressure'].values, \
+                      Flow=df['Flow'].values, Valve=df['Valve'].values, source=array(key[0]), \
+                      stamp=array([key[1], key[2]], dtype='float64'))
+            replace(tmp, fname)
+            with self.spill_lock:
+                spilled = self._spilled()
+                size = path.getsize(fname)
+                self.spill_size += size - spilled.get(fname, 0)
+                spilled[fname] = size
+                spilled.move_to_end(fname)
+                self._evict_spill()
+
+    def _touch_spill(self, fname):
+        """
+        True if the spill file is known, it is marked as the most recently used
+        """
+        with self.spill_lock:
+            spilled = self._spilled()
+            if fname not in spilled:
+                return False
+            spilled.move_to_end(fname)
+            return True
+
+    def _spilled(self,):
+        """
+        Spill files by their last use, called with spill_lock held. On first use the spill directory
+        is scanned and the files of daily files that changed or no longer exist, e.g. that were
+        compressed, are removed
+        """
+        if self.spilled is not None:
+            return self.spilled
+        entries = []
+        names = listdir(self.spill_dir) if path.isdir(self.spill_dir) else []
+        for name in [name for name in names if name.endswith('.npz')]:
+            fname = path.join(self.spill_dir, name)
+            try:
+                with load(fname) as z:
+                    source, stamp = str(z['source']), z['stamp']
+                st = stat(source) if path.isfile(source) else None
+                if st is None or (st.st_size, st.st_mtime) != (stamp[0], stamp[1]):
+                    remove(fname)
+                    continue
+                entries.append((stat(fname).st_mtime, fname, stat(fname).st_size))
+            except Exception:
+                # unreadable or of an older version
+                try:
+                    remove(fname)
+                except OSError:
+                    pass
+        self.spilled = OrderedDict((fname, size) for mtime, fname, size in sorted(entries))
+        self.spill_size = sum(self.spilled.values())
+        self._evict_spill()
+        return self.spilled
+
+    def _evict_spill(self,):
+        while self.spill_size > self.spill_budget and len(self.spilled) > 1:
+            fname, size = self.spilled.popitem(last=False)
+            self.spill_size -= size
+            try:
+                remove(fname)
+            except OSError:
+                pass
+
+    def _add(self, key, df):
+        nbytes = int(df.memory_usage(index=False).sum())
+        with self.lock:
+            if key in self.frames:
+                return
+            self.frames[key] = df
+            self.size += nbytes
+            while self.size > self.budget and len(self.frames) > 1:
+                old_key, old = self.frames.popitem(last=False)
+                self.size -= int(old.memory_usage(index=False).sum())
+
+    def snapshot(self,):
+        """
+        Files and MB held in memory, MB in the spill directory and the memory hits, disk hits and
+        misses so far
+        """
+        with self.lock:
+            return {'files': len(self.frames), 'mb': self.size/2**20, 'disk_mb': self.spill_size/2**20, \
+                    'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+CACHE = FileCache()
+
+class TailReader:
+    """
+    Reads files that are still being written incrementally. The byte offset, the partial last
+    line and the parsed chunks are kept per file, a read parses only the lines appended since
+    the last one. A file that shrank or was replaced is read again from the start
+    """
+
+    def __init__(self,):
+        # path: [offset, partial line, chunks, (device, inode)]
+        self.files = {}
+        self.lock = Lock()
+
+    def read(self, filename):
+        """
+        Returns the list of dataframes with all complete lines of the file
+        """
+        fname = path.abspath(filename)
+        with self.lock:
+            st = stat(fname)
+            state = self.files.get(fname)
+            if state is None or st.st_size < state[0] or state[3] != (st.st_dev, st.st_ino):
+                state = [0, b'', [], (st.st_dev, st.st_ino)]
+                self.files[fname] = state
+            if st.st_size > state[0]:
+                with open(fname, 'rb') as f:
+                    f.seek(state[0])
+                    data = f.read(st.st_size - state[0])
+                state[0] += len(data)
+                data = state[1] + data
+                end = data.rfind(b'\n') + 1
+                state[1] = data[end:]
+                if end > 0:
+                    state[2].append(parse_lines(BytesIO(data[:end])))
+                if len(state[2]) > TAIL_CHUNKS:
+                    state[2] = [concat(state[2], ignore_index=True)]
+            return list(state[2])
+
+    def forget(self,):
+        """
+        Drops the state of the files that are no longer today's, e.g. of yesterday after midnight
+        """
+        with self.lock:
+            for fname in list(self.files):
+                if not _is_today(fname):
+                    del self.files[fname]
+
+TAIL = TailReader()
+
+def configure_cache(size_mb, spill_dir='', spill_mb=CACHE_DIR_SIZE):
+    """
+    Sets the memory budget in MB, the spill directory and its disk budget in MB of the process wide cache
+    """
+    CACHE.budget = int(size_mb*2**20)
+    with CACHE.spill_lock:
+        CACHE.spill_dir = spill_dir
+        CACHE.spill_budget = int(spill_mb*2**20)
+        # scanned again on first use
+        CACHE.spilled = None
+        CACHE.spill_size = 0
+
+def _is_today(filename):
+    name = path.basename(filename)
+    if name.endswith(bpc_store.GZ):
+        name = name[:-len(bpc_store.GZ)]
+    return name == path.basename(bpc_store.txt_name('', datetime.now()))
+
+def read_files(filenames, pool=None):
+    """
+    Returns ([dataframe], error) of every file in the given order. The past days are served from
+    CACHE, the others are parsed by the process pool if given and the past days among them cached.
+    Today's file is still being written, only its new lines are parsed by TAIL
+    """
+    results = [None]*len(filenames)
+    keys = [None]*len(filenames)
+    todo = []
+    TAIL.forget()
+    for n, filename in enumerate(filenames):
+        if _is_today(filename) and path.isfile(filename):
+            try:
+                results[n] = (TAIL.read(filename), None)
+            except Exception as e:
+                results[n] = ([], str(e))
+            continue
+        try:
+            keys[n] = CACHE.key(filename)
+        except OSError:
+            keys[n] = None
+        df = CACHE.get(keys[n]) if keys[n] is not None else None
+        if df is not None:
+            results[n] = ([df], None)
+        else:
+            todo.append(n)
+    parsed = None
+    if pool is not None and len(todo) > 1:
+        try:
+            parsed = list(pool.map(read_day, [filenames[n] for n in todo]))
+        except Exception:
+            # e.g. a worker process died, read them here
+            parsed = None
+    if parsed is None:
+        parsed = [read_day(filenames[n]) for n in todo]
+    for n, result in zip(todo, parsed):
+        results[n] = result
+        data, error = result
+        if keys[n] is not None and error is None and data != []:
+            try:
+                CACHE.put(keys[n], data[0])
+            except Exception:
+                pass
+    return results
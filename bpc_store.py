@@ -0,0 +1,978 @@
+#! /usr/bin/env python
+"""
+Storage formats of the daily bpc data files besides the tab separated text logs.
+
+A day bpc_log_YYYYMMDD.txt can be stored column wise as bpc_log_YYYYMMDD.npz with
+    time      int64, ns since 1970-01-01 of the local wall clock as in the text files
+    pressure  float32, mbar
+    flow      float32, l/min, correction factor applied
+    valve     float32, %
+so the history is loaded without parsing text and timestamps.
+
+All days can also be appended to one binary log bpc_log.bin of fixed size records
+    time      int64, ns since the epoch, i.e. UTC, so it keeps increasing when the clocks go back
+    pressure, flow, valve  float32
+    status    uint8, STATUS_* bits of the registers that were read
+padded to RECORD_SIZE bytes. The log is read as a numpy.memmap, the records are in time order
+so a range is found by a binary search on the time column without reading the archive.
+
+The logs besides the text files are back-filled from the daily files when they are enabled, the
+stores that cover the whole archive are marked complete in bpc_stores.json, see needs_backfill().
+
+Rollup tiers bpc_rollup_1min.bin, _1h and _1d keep per bucket the count, sum, min, max and last
+value of every column, the start of the bucket and the time of its last sample in ns since the
+epoch. The buckets are minutes, hours and days of the local wall clock, see bucket_starts(). They are
+maintained by Rollups as the samples arrive and appended when a bucket is complete, a history
+request is served by query_rollups() from the coarsest tiers that fit its binning.
+
+The manifest bpc_manifest.json lists every closed daily file with its first and last timestamp
+in ns of the local wall clock, row count, rows with a NaN, byte size, mtime and flow sum, so a range is mapped to its files by
+a binary search instead of listing the data directory. Rebuild it with
+    python bpc_store.py --manifest DATADIR
+
+The samples and their derived values can also be kept in the sqlite database bpc_log.sqlite,
+table samples with the time in ns since the epoch as integer primary key, in WAL mode so several readers
+query it while the monitor writes. Ranges and bucket aggregates are computed by sqlite.
+
+Whole archives are converted column wise with
+    python bpc_store.py --convert DATADIR
+
+Closed daily files can be compressed to bpc_log_YYYYMMDD.txt.gz, all functions here take the
+name of the text file and read whichever of the two exists, see day_file() and open_text().
+Only numpy is needed.
+"""
+
+import gzip
+import inspect
+import json
+import logging
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+from urllib.request import pathname2url
+from bisect import bisect_left, bisect_right
+from os import path, replace, listdir, stat, remove
+from shutil import copyfileobj, copystat
+from datetime import datetime, timedelta, timezone
+from math import gcd
+from numpy import array, float32, float64, int64, uint8, uint32, savez, load, dtype, memmap, zeros, isnan, datetime64, \
+                  arange, where, flatnonzero, diff, concatenate, add, fmin, fmax, maximum, NaN, asarray, unique, \
+                  cumsum
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+COLUMNS = ('pressure', 'flow', 'valve')
+MANIFEST = 'bpc_manifest.json'
+CONVERT_STATE = 'bpc_convert.json'
+SQLITE = 'bpc_log.sqlite'
+# int64 range of the time column for an open start or end
+MIN_NS, MAX_NS = -2**63, 2**63 - 1
+# the UTC offset of the local time zone is looked up once per quarter hour, it only changes on quarter hours
+OFFSET_STEP = 900*10**9
+EPOCH = datetime(1970, 1, 1)
+CONVERT_REJECTS = 'bpc_convert_rejects.txt'
+GZ = '.gz'
+BINLOG = 'bpc_log.bin'
+STORES = 'bpc_stores.json'
+# s a store may lag behind the daily files before it is back-filled again, e.g. after a crash
+STORE_GAP = 60
+RECORD_SIZE = 24
+RECORD = dtype({'names': ['time', 'pressure', 'flow', 'valve', 'status'],
+                'formats': [int64, float32, float32, float32, uint8],
+                'offsets': [0, 8, 12, 16, 20],
+                'itemsize': RECORD_SIZE})
+STATUS_PRESSURE = 1
+STATUS_FLOW = 2
+STATUS_VALVE = 4
+# rollup tiers, name: bucket length in s
+TIERS = {'1min': 60, '1h': 3600, '1d': 86400}
+AGGREGATES = (('count', uint32), ('sum', float64), ('min', float32), ('max', float32), ('last', float32))
+ROLLUP = dtype([('time', int64), ('end', int64)] + \
+               [(name + '_' + agg, t) for name in COLUMNS for agg, t in AGGREGATES])
+
+def npz_name(txt_fname):
+    """
+    Columnar file of the text file txt_fname or of its compressed file
+    """
+    if txt_fname.endswith(GZ):
+        txt_fname = txt_fname[:-len(GZ)]
+    return path.splitext(txt_fname)[0] + '.npz'
+
+def txt_name(datadir, day):
+    """
+    Daily data file of the date or datetime day, as Controller.data_fname()
+    """
+    return path.join(datadir, 'bpc_log_' + day.strftime("%Y%m%d") + '.txt')
+
+def daily_files(datadir):
+    """
+    Names of the daily text files of the data directory, oldest first. A compressed
+    file is listed under the name of its text file
+    """
+    names = set()
+    for f in listdir(datadir):
+        if f.endswith(GZ):
+            f = f[:-len(GZ)]
+        if f.startswith('bpc_log_') and f.endswith('.txt'):
+            names.add(f)
+    return sorted(names)
+
+def day_file(txt_fname):
+    """
+    The text file if it exists, else its compressed file if that exists, else None
+    """
+    if path.isfile(txt_fname):
+        return txt_fname
+    if path.isfile(txt_fname + GZ):
+        return txt_fname + GZ
+    return None
+
+def open_text(txt_fname):
+    """
+    Opens the text file or its compressed file for reading lines
+    """
+    fname = day_file(txt_fname)
+    if fname is None:
+        raise FileNotFoundError(txt_fname)
+    if fname.endswith(GZ):
+        return gzip.open(fname, 'rt')
+    return open(fname, 'r')
+
+def compress_txt(txt_fname, level=6):
+    """
+    Compresses a closed daily text file to txt_fname.gz and removes the text file,
+    the compressed file keeps its mtime. Returns the compressed file name or None
+    """
+    gz_fname = txt_fname + GZ
+    tmp = gz_fname + '.tmp'
+    try:
+        with open(txt_fname, 'rb') as f, gzip.open(tmp, 'wb', compresslevel=level) as g:
+            copyfileobj(f, g, 1 << 20)
+        copystat(txt_fname, tmp)
+        replace(tmp, gz_fname)
+        remove(txt_fname)
+    except Exception as e:
+        logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(txt_fname) + " Exception: " + str(e))
+        return None
+    return gz_fname
+
+def parse_txt(txt_fname, rejects=None):
+    """
+    Returns the columns of a text data file as a dict of numpy arrays, lines that
+    can not be parsed are skipped and appended to rejects as (line number, line) if given
+    """
+    dates = []
+    values = []
+    numbers = []
+    with open_text(txt_fname) as f:
+        for n, line in enumerate(f, 1):
+            fields = line.rstrip('\n').split('\t')
+            try:
+                if len(fields) < 4:
+                    raise ValueError
+                values.append((float(fields[1]), float(fields[2]), float(fields[3])))
+            except ValueError:
+                if rejects is not None and line.strip() != '':
+                    rejects.append((n, line.rstrip('\n')))
+                continue
+            dates.append(fields[0])
+            numbers.append(n)
+    try:
+        t = array(dates, dtype='datetime64[ns]').astype(int64)
+    except ValueError:
+        # a bad date somewhere, fall back to parsing them one by one
+        t, keep = [], []
+        for i, d in enumerate(dates):
+            try:
+                t.append(array(d, dtype='datetime64[ns]').astype(int64))
+                keep.append(i)
+            except ValueError:
+                if rejects is not None:
+                    rejects.append((numbers[i], '\t'.join([d] + [str(x) for x in values[i]])))
+                continue
+        t = array(t, dtype=int64)
+        values = [values[i] for i in keep]
+    v = array(values, dtype=float32).reshape(-1, 3)
+    columns = {'time': t}
+    for n, name in enumerate(COLUMNS):
+        columns[name] = v[:, n].copy()
+    return columns
+
+def write_npz(npz_fname, columns):
+    """
+    Writes the columns to npz_fname through a temporary file so readers never see a partial file
+    """
+    tmp = npz_fname + '.tmp'
+    with open(tmp, 'wb') as f:
+        savez(f, **columns)
+    replace(tmp, npz_fname)
+
+def read_npz(npz_fname):
+    """
+    Returns the columns of a columnar data file as a dict of numpy arrays
+    """
+    with load(npz_fname) as z:
+        return {name: z[name] for name in ('time',) + COLUMNS}
+
+def txt_to_npz(txt_fname):
+    """
+    Stores the text data file column wise next to it, returns the columnar file name or None
+    """
+    try:
+        columns = parse_txt(txt_fname)
+        npz_fname = npz_name(txt_fname)
+        write_npz(npz_fname, columns)
+    except Exception as e:
+        logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(txt_fname) + " Exception: " + str(e))
+        return None
+    logger.info("Stored " + str(len(columns['time'])) + " samples of " + str(txt_fname) + " column wise")
+    return npz_fname
+
+def has_npz(txt_fname):
+    """
+    True if the columnar file of txt_fname exists and is not older than the text file
+    """
+    npz_fname = npz_name(txt_fname)
+    fname = day_file(txt_fname)
+    return fname is not None and path.isfile(npz_fname) and path.getmtime(npz_fname) >= path.getmtime(fname)
+
+def binlog_name(datadir):
+    """
+    Binary log of the data directory
+    """
+    return path.join(datadir, BINLOG)
+
+def to_ns(t):
+    """
+    ns since the epoch of a datetime, naive ones are local time, of a unix timestamp in s or of an
+    ISO 8601 string of the local time
+    """
+    if isinstance(t, str):
+        t = datetime.fromisoformat(t)
+    if isinstance(t, datetime):
+        return int(t.replace(microsecond=0).timestamp())*10**9 + t.microsecond*1000
+    return int(round(t*10**6))*1000
+
+def wall_ns(t):
+    """
+    ns of the local wall clock of a datetime, of a unix timestamp in s or of a string, as the dates
+    of the text files
+    """
+    if isinstance(t, (int, float)):
+        t = datetime.fromtimestamp(t)
+    return int(datetime64(t, 'ns').astype(int64))
+
+def _steps(times):
+    """
+    Quarter hours of the ns times and the index of every time into them
+    """
+    steps = times//OFFSET_STEP
+    if len(steps) > 0 and steps.max() - steps.min() < len(steps):
+        # a range shorter than the array, e.g. the samples of a few days, no need to sort
+        first = int(steps.min())
+        return arange(first, int(steps.max()) + 1), steps - first
+    return unique(steps, return_inverse=True)
+
+def to_wall_ns(times):
+    """
+    ns of the local wall clock of the ns since the epoch times, e.g. to display them
+    """
+    times = asarray(times, dtype=int64)
+    steps, inverse = _steps(times)
+    offsets = array([int(datetime.fromtimestamp(int(step)*OFFSET_STEP//10**9, timezone.utc).astimezone().utcoffset().total_seconds()) \
+                     for step in steps], dtype=int64)*10**9
+    return times + offsets[inverse]
+
+def to_epoch_ns(wall):
+    """
+    ns since the epoch of the ns of the local wall clock, e.g. of the dates of a text file in the order
+    they were written. In the hour that repeats when the clocks go back the times after the clock stepped
+    back are taken as the second one
+    """
+    wall = asarray(wall, dtype=int64)
+    steps, inverse = _steps(wall)
+    offsets = zeros((len(steps), 2), dtype=int64)
+    for n, step in enumerate(steps):
+        t = EPOCH + timedelta(microseconds=int(step)*OFFSET_STEP//1000)
+        for fold in (0, 1):
+            offsets[n, fold] = int(step)*OFFSET_STEP//10**9 - int(t.replace(fold=fold).timestamp())
+    offsets = offsets*10**9
+    first, second = offsets[inverse, 0], offsets[inverse, 1]
+    stepped_back = cumsum(concatenate(([False], diff(wall) < 0))) > 0 if len(wall) > 0 else zeros(0, dtype=bool)
+    return wall - where((first != second) & stepped_back, second, first)
+
+def bucket_starts(times, seconds):
+    """
+    Starts in ns since the epoch of the buckets of seconds of the local wall clock, e.g. the local days,
+    that hold the ns since the epoch times
+    """
+    length = seconds*10**9
+    wall = to_wall_ns(times)
+    if seconds < 86400:
+        # the hour that repeats when the clocks go back is a bucket of its own
+        return times - wall % length
+    return to_epoch_ns(wall//length*length)
+
+def day_columns(txt_fname):
+    """
+    Columns of a daily file, from its columnar file if it is up to date, with the time in ns since the epoch
+    """
+    columns = read_npz(npz_name(txt_fname)) if has_npz(txt_fname) else parse_txt(txt_fname)
+    columns['time'] = to_epoch_ns(columns['time'])
+    return columns
+
+def records(samples):
+    """
+    Fixed size records of the samples
+    """
+    return columns_records({'time': array([to_ns(sample.timestamp) for sample in samples], dtype=int64),
+                            'pressure': array([sample.pressure for sample in samples], dtype=float32),
+                            'flow': array([sample.flow for sample in samples], dtype=float32),
+                            'valve': array([sample.valve for sample in samples], dtype=float32)})
+
+def columns_records(columns):
+    """
+    Fixed size records of the columns with the time in ns since the epoch
+    """
+    recs = zeros(len(columns['time']), dtype=RECORD)
+    recs['time'] = columns['time']
+    for name, bit in zip(COLUMNS, (STATUS_PRESSURE, STATUS_FLOW, STATUS_VALVE)):
+        recs[name] = columns[name]
+        recs['status'] |= where(isnan(columns[name]), 0, bit).astype(uint8)
+    return recs
+
+def open_binlog(fname, record=RECORD):
+    """
+    Opens a file of fixed size records for appending, a partial record left by a crash is cut off
+    """
+    f = open(fname, 'ab')
+    size = f.tell()
+    if size % record.itemsize != 0:
+        logger.info("Dropping " + str(size % record.itemsize) + " bytes of a partial record at the end of " + str(fname))
+        f.truncate(size - size % record.itemsize)
+    return f
+
+def read_binlog(fname, record=RECORD):
+    """
+    Read only memmap of all complete records of a file of fixed size records, e.g. the binary log,
+    nothing is read until it is sliced
+    """
+    n = path.getsize(fname)//record.itemsize if path.isfile(fname) else 0
+    if n == 0:
+        return zeros(0, dtype=record)
+    return memmap(fname, dtype=record, mode='r', shape=(n,))
+
+def query_binlog(fname, start=None, end=None):
+    """
+    Records of the binary log with start <= time <= end, both datetime, unix timestamps in s or None
+    for an open end. Returns a view into the memmap, found with two binary searches
+    """
+    recs = read_binlog(fname)
+    times = recs['time']
+    i = 0 if start is None else int(times.searchsorted(to_ns(start), side='left'))
+    j = len(recs) if end is None else int(times.searchsorted(to_ns(end), side='right'))
+    return recs[i:j]
+
+def build_binlog(datadir, end, fname):
+    """
+    Writes the samples of the daily files of the data directory taken before end, ns since the epoch,
+    to the binary log fname, e.g. the archive logged before the binary log was enabled. Returns their number
+    """
+    n = 0
+    with open(fname, 'wb') as f:
+        for name in daily_files(datadir):
+            txt_fname = path.join(datadir, name)
+            try:
+                columns = day_columns(txt_fname)
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(txt_fname) + " Exception: " + str(e))
+                continue
+            recs = columns_records(columns)
+            recs = recs[recs['time'] < end]
+            f.write(recs.tobytes())
+            n += len(recs)
+    return n
+
+def splice_binlog(fname, archive, start, record=RECORD, key='time'):
+    """
+    Appends the records of the file of fixed size records fname from the first one with key >= start,
+    ns since the epoch, to the file archive and replaces fname by it
+    """
+    if path.isfile(fname):
+        recs = read_binlog(fname, record)
+        i, n = int(recs[key].searchsorted(start, side='left')), len(recs)
+        # the memmap has to be closed before the file is replaced
+        del recs
+        with open(fname, 'rb') as src, open(archive, 'ab') as dst:
+            src.seek(i*record.itemsize)
+            dst.write(src.read((n - i)*record.itemsize))
+    replace(archive, fname)
+
+def rollup_name(datadir, tier):
+    """
+    Rollup file of the tier in the data directory
+    """
+    return path.join(datadir, 'bpc_rollup_' + tier + '.bin')
+
+def aggregate(times, columns, seconds):
+    """
+    Rollup records of the samples at times (int64 ns since the epoch, ascending) with the given columns
+    in buckets of seconds of the local wall clock, one record per bucket that has samples
+    """
+    bucket = bucket_starts(times, seconds)
+    starts = concatenate(([0], flatnonzero(diff(bucket)) + 1)) if len(times) > 0 else zeros(0, dtype=int64)
+    ends = concatenate((starts[1:], [len(times)])) - 1
+    recs = zeros(len(starts), dtype=ROLLUP)
+    recs['time'] = bucket[starts]
+    recs['end'] = times[ends]
+    idx = arange(len(times))
+    for name in COLUMNS:
+        x = columns[name].astype(float64)
+        valid = ~isnan(x)
+        recs[name + '_count'] = add.reduceat(valid.astype(uint32), starts)
+        recs[name + '_sum'] = add.reduceat(where(valid, x, 0.0), starts)
+        recs[name + '_min'] = fmin.reduceat(x, starts)
+        recs[name + '_max'] = fmax.reduceat(x, starts)
+        last = maximum.reduceat(where(valid, idx, -1), starts)
+        recs[name + '_last'] = where(last >= 0, x[last], NaN)
+    return recs
+
+def merge(a, b):
+    """
+    Merges the rollup records b into a of the same buckets, b holds the later samples
+    """
+    a['end'] = maximum(a['end'], b['end'])
+    for name in COLUMNS:
+        a[name + '_count'] += b[name + '_count']
+        a[name + '_sum'] += b[name + '_sum']
+        a[name + '_min'] = fmin(a[name + '_min'], b[name + '_min'])
+        a[name + '_max'] = fmax(a[name + '_max'], b[name + '_max'])
+        a[name + '_last'] = where(b[name + '_count'] > 0, b[name + '_last'], a[name + '_last'])
+
+class Rollups:
+    """
+    Keeps the open bucket of every tier of one data directory and appends the buckets
+    to their tier file, with the suffix if given, when they are complete. Not thread safe,
+    used by the writer thread
+    """
+
+    def __init__(self, datadir, suffix=''):
+        self.datadir = datadir
+        self.suffix = suffix
+        self.files = {}
+        # tier: rollup record of the open bucket as array of length one or None
+        self.open = dict.fromkeys(TIERS)
+
+    def add(self, times, columns):
+        """
+        Adds samples at times (int64 ns since the epoch, ascending) with the given columns
+        """
+        if len(times) == 0:
+            return
+        for tier, seconds in TIERS.items():
+            recs = aggregate(times, columns, seconds)
+            current = self.open[tier]
+            if current is not None:
+                if current['time'][0] == recs['time'][0]:
+                    merge(current, recs[:1])
+                    recs[:1] = current
+                else:
+                    self._append(tier, current)
+            self._append(tier, recs[:-1])
+            self.open[tier] = recs[-1:].copy()
+
+    def add_records(self, recs):
+        """
+        Adds binary log records
+        """
+        self.add(recs['time'], {name: recs[name] for name in COLUMNS})
+
+    def _append(self, tier, recs):
+        if len(recs) == 0:
+            return
+        f = self.files.get(tier)
+        if f is None:
+            f = open_binlog(rollup_name(self.datadir, tier) + self.suffix, ROLLUP)
+            self.files[tier] = f
+        f.write(recs.tobytes())
+        f.flush()
+
+    def release(self,):
+        """
+        Closes the tier files, they are opened again by the next bucket that is appended
+        """
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def close(self,):
+        """
+        Appends the open buckets, a bucket continued after a restart is merged when it is read
+        """
+        for tier in TIERS:
+            if self.open[tier] is not None:
+                self._append(tier, self.open[tier])
+                self.open[tier] = None
+        self.release()
+
+def build_rollups(datadir, end=None, suffix=''):
+    """
+    Builds the rollup tiers of the data directory, with the suffix if given, from the samples of its
+    daily files taken before end, ns since the epoch, e.g. for the archive that was logged before the
+    rollups were enabled. Returns the number of samples. Every tier file is written, empty if there
+    are no samples
+    """
+    for tier in TIERS:
+        open(rollup_name(datadir, tier) + suffix, 'wb').close()
+    rollups = Rollups(datadir, suffix)
+    n = 0
+    for fname in daily_files(datadir):
+        txt_fname = path.join(datadir, fname)
+        try:
+            columns = day_columns(txt_fname)
+            if end is not None:
+                keep = columns['time'] < end
+                columns = {name: x[keep] for name, x in columns.items()}
+            rollups.add(columns['time'], columns)
+            n += len(columns['time'])
+        except Exception as e:
+            logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(txt_fname) + " Exception: " + str(e))
+    rollups.close()
+    logger.info("Built the rollups of " + str(n) + " samples in " + str(datadir))
+    return n
+
+def store_state(datadir):
+    """
+    Stores of the data directory and whether they cover the whole archive
+    """
+    fname = path.join(datadir, STORES)
+    if not path.isfile(fname):
+        return {}
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+def store_complete(datadir, store):
+    """
+    True if the store, 'binlog', 'rollup' or 'sqlite', holds every sample of the daily files
+    """
+    return store_state(datadir).get(store, False)
+
+def set_store_complete(datadir, store, complete):
+    state = store_state(datadir)
+    state[store] = complete
+    write_json(path.join(datadir, STORES), state)
+
+def last_sample(datadir):
+    """
+    ns since the epoch of the last sample of the daily files of the data directory or None
+    """
+    for name in reversed(daily_files(datadir)):
+        fname = day_file(path.join(datadir, name))
+        if fname.endswith(GZ):
+            with open_text(fname[:-len(GZ)]) as f:
+                lines = f.readlines()
+        else:
+            with open(fname, 'rb') as f:
+                f.seek(max(0, stat(fname).st_size - 4096))
+                lines = f.read().decode('utf-8', 'replace').splitlines()
+        for line in reversed(lines):
+            try:
+                return to_ns(line.split('\t')[0])
+            except ValueError:
+                continue
+    return None
+
+def store_last(datadir, store):
+    """
+    ns since the epoch of the last sample held by the store or None if it is empty
+    """
+    if store == 'binlog':
+        recs = read_binlog(binlog_name(datadir))
+        return int(recs['time'][-1]) if len(recs) > 0 else None
+    if store == 'rollup':
+        # the open buckets are only appended at shutdown, after a crash the coarse tiers lag behind
+        ends = []
+        for tier in TIERS:
+            recs = read_binlog(rollup_name(datadir, tier), ROLLUP)
+            if len(recs) == 0:
+                return None
+            ends.append(int(recs['end'][-1]))
+        return min(ends)
+    if store == 'sqlite' and path.isfile(sqlite_name(datadir)):
+        conn = connect_sqlite(sqlite_name(datadir))
+        try:
+            return conn.execute('SELECT max(time) FROM samples').fetchone()[0]
+        finally:
+            conn.close()
+    return None
+
+def needs_backfill(datadir, store):
+    """
+    True if the store is not complete or lags behind the daily files, e.g. because the monitor ran
+    without it for a while
+    """
+    if not store_complete(datadir, store):
+        return True
+    last = last_sample(datadir)
+    if last is None:
+        return False
+    held = store_last(datadir, store)
+    return held is None or held < last - STORE_GAP*10**9
+
+def sqlite_name(datadir):
+    """
+    sqlite database of the data directory
+    """
+    return path.join(datadir, SQLITE)
+
+class SqliteLog:
+    """
+    Appends the samples and their derived values to the sqlite database of one data directory.
+    The connection belongs to the thread that created it, i.e. the writer thread
+    """
+
+    def __init__(self, fname):
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # a power loss may lose the last transactions but never corrupts the database
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS samples (time INTEGER PRIMARY KEY, pressure REAL, ' + \
+                          'flow REAL, valve REAL, recovered REAL, remaining_lhe REAL)')
+        self.conn.commit()
+
+    def insert(self, samples):
+        """
+        Inserts a batch of samples in one transaction, NaN is stored as NULL
+        """
+        rows = [(to_ns(sample.timestamp), sample.pressure, sample.flow, sample.valve, sample.recovered, \
+                 sample.remaining_lHe) for sample in samples]
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def close(self,):
+        self.conn.close()
+
+def backfill_sqlite(datadir, end, expansion_ratio, batch=20000):
+    """
+    Replaces the rows of the sqlite database of the data directory before end, ns since the epoch, by
+    the samples of its daily files, e.g. the archive logged before the database was enabled. The lHe rec.
+    is computed from the logged flow, the remaining lHe is not known. Runs beside the writer thread, each
+    batch of rows is a transaction of its own. Returns the number of rows
+    """
+    log = SqliteLog(sqlite_name(datadir))
+    n = 0
+    try:
+        with log.conn:
+            log.conn.execute('DELETE FROM samples WHERE time < ?', (end,))
+        for name in daily_files(datadir):
+            txt_fname = path.join(datadir, name)
+            try:
+                columns = day_columns(txt_fname)
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(txt_fname) + " Exception: " + str(e))
+                continue
+            keep = columns['time'] < end
+            flow = columns['flow'][keep].astype(float64)
+            rows = list(zip(columns['time'][keep].tolist(), columns['pressure'][keep].astype(float64).tolist(), \
+                            flow.tolist(), columns['valve'][keep].astype(float64).tolist(), \
+                            (flow*60*24/expansion_ratio).tolist(), [None]*len(flow)))
+            for k in range(0, len(rows), batch):
+                with log.conn:
+                    log.conn.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?)', rows[k:k + batch])
+            n += len(rows)
+    finally:
+        log.close()
+    return n
+
+def connect_sqlite(fname):
+    """
+    Read only connection to a sqlite database written by SqliteLog
+    """
+    return sqlite3.connect('file:' + pathname2url(path.abspath(fname)) + '?mode=ro', uri=True)
+
+def _ns_range(start, end):
+    return (MIN_NS if start is None else to_ns(start), MAX_NS if end is None else to_ns(end))
+
+def query_sqlite(fname, bin_seconds, start=None, end=None):
+    """
+    Rows (bucket start in ns since the epoch, then count and sum of pressure, flow and valve) of the
+    buckets between start and end, datetime, unix timestamps in s or None for an open end. The buckets
+    divide bin_seconds and a quarter hour, so they also add up to the bins of the local wall clock
+    """
+    b = gcd(int(bin_seconds), OFFSET_STEP//10**9)*10**9
+    conn = connect_sqlite(fname)
+    try:
+        return conn.execute('SELECT time/? * ? AS bucket, count(pressure), total(pressure), count(flow), total(flow), ' + \
+                            'count(valve), total(valve) FROM samples WHERE time BETWEEN ? AND ? ' + \
+                            'GROUP BY bucket ORDER BY bucket', (b, b) + _ns_range(start, end)).fetchall()
+    finally:
+        conn.close()
+
+def query_sqlite_sum(fname, start=None, end=None):
+    """
+    Rows (minute in ns since the epoch, sum of the mean flow of every second of the minute) between start and end
+    """
+    conn = connect_sqlite(fname)
+    try:
+        return conn.execute('SELECT s/60 * 60000000000 AS minute, total(f) FROM ' + \
+                            '(SELECT time/1000000000 AS s, avg(flow) AS f FROM samples WHERE time BETWEEN ? AND ? ' + \
+                            'GROUP BY s) GROUP BY minute ORDER BY minute', _ns_range(start, end)).fetchall()
+    finally:
+        conn.close()
+
+def file_entry(txt_fname):
+    """
+    Manifest entry of a daily text file
+    """
+    st = stat(day_file(txt_fname))
+    columns = read_npz(npz_name(txt_fname)) if has_npz(txt_fname) else parse_txt(txt_fname)
+    times = columns['time']
+    nans = isnan(columns['pressure']) | isnan(columns['flow']) | isnan(columns['valve'])
+    flow = columns['flow'][~isnan(columns['flow'])]
+    return {'name': path.basename(txt_fname),
+            'first': int(times[0]) if len(times) > 0 else None,
+            'last': int(times[-1]) if len(times) > 0 else None,
+            'rows': int(len(times)),
+            'nans': int(nans.sum()),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'flow_sum': float(flow.astype(float64).sum())}
+
+class Manifest:
+    """
+    Index of the closed daily files of one data directory, sorted by time
+    """
+
+    def __init__(self, datadir):
+        self.datadir = datadir
+        self.fname = path.join(datadir, MANIFEST)
+        self.entries = []
+
+    def load(self,):
+        """
+        Reads the manifest, returns False if there is none
+        """
+        if not path.isfile(self.fname):
+            return False
+        try:
+            with open(self.fname, 'r') as f:
+                self.entries = json.load(f)['files']
+        except (ValueError, KeyError) as e:
+            logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(self.fname) + " Exception: " + str(e))
+            self.entries = []
+            return False
+        self._index()
+        return True
+
+    def save(self,):
+        """
+        Writes the manifest through a temporary file so readers never see a partial one
+        """
+        write_json(self.fname, {'version': 1, 'files': self.entries})
+
+    def _index(self,):
+        self.entries = sorted((e for e in self.entries if e['rows'] > 0), key=lambda e: e['first'])
+        self.firsts = [e['first'] for e in self.entries]
+        self.lasts = [e['last'] for e in self.entries]
+
+    def update(self, txt_fname):
+        """
+        Adds or replaces the entry of a daily file
+        """
+        entry = file_entry(txt_fname)
+        self.entries = [e for e in self.entries if e['name'] != entry['name']] + [entry]
+        self._index()
+
+    def rebuild(self,):
+        """
+        Indexes every closed daily file of the data directory and saves the manifest
+        """
+        self.entries = []
+        today = path.basename(txt_name(self.datadir, datetime.now()))
+        for fname in daily_files(self.datadir):
+            if fname == today:
+                # still being written
+                continue
+            try:
+                self.entries.append(file_entry(path.join(self.datadir, fname)))
+            except Exception as e:
+                logger.info("In function: " +  inspect.stack()[0][3] + " In file: " + str(fname) + " Exception: " + str(e))
+        self._index()
+        self.save()
+        logger.info("Indexed " + str(len(self.entries)) + " daily files in " + str(self.datadir))
+
+    def select(self, start=None, end=None):
+        """
+        Entries of the files with samples between start and end, datetime, unix timestamps in s
+        or None for an open end, found by binary search
+        """
+        i = 0 if start is None else bisect_left(self.lasts, wall_ns(start))
+        j = len(self.entries) if end is None else bisect_right(self.firsts, wall_ns(end))
+        return self.entries[i:j]
+
+    def unindexed(self, end=None):
+        """
+        Daily files after the last indexed one up to end or today, e.g. the file being written
+        """
+        if self.entries == []:
+            return [path.join(self.datadir, fname) for fname in daily_files(self.datadir)]
+        day = datetime.strptime(self.entries[-1]['name'][len('bpc_log_'):-len('.txt')], "%Y%m%d") + timedelta(days=1)
+        last = datetime.now() if end is None else (end if isinstance(end, datetime) else datetime.fromtimestamp(end))
+        fnames = []
+        while day.date() <= last.date():
+            fname = txt_name(self.datadir, day)
+            if day_file(fname) is not None:
+                fnames.append(fname)
+            day = day + timedelta(days=1)
+        return fnames
+
+def convert_file(txt_fname):
+    """
+    Stores one daily file column wise, runs in a worker process of convert_archive().
+    Returns its name, size, mtime, rows, rejected lines and the time taken in s
+    """
+    start = perf_counter()
+    st = stat(day_file(txt_fname))
+    rejects = []
+    columns = parse_txt(txt_fname, rejects)
+    write_npz(npz_name(txt_fname), columns)
+    return {'name': path.basename(txt_fname), 'size': st.st_size, 'mtime': st.st_mtime,
+            'rows': int(len(columns['time'])), 'rejects': rejects, 'seconds': perf_counter() - start}
+
+def convert_archive(datadir, workers=None, force=False):
+    """
+    Stores every closed daily file of the data directory column wise using a process pool and
+    rebuilds the manifest. The state of every converted file is kept in bpc_convert.json, a file
+    whose size and mtime did not change since is skipped, so an interrupted run resumes and a
+    repeated run does nothing. The rejected lines are listed in bpc_convert_rejects.txt
+    """
+    state_fname = path.join(datadir, CONVERT_STATE)
+    state = {}
+    if path.isfile(state_fname) and not force:
+        with open(state_fname, 'r') as f:
+            state = json.load(f)
+    today = path.basename(txt_name(datadir, datetime.now()))
+    todo = []
+    for name in daily_files(datadir):
+        txt_fname = path.join(datadir, name)
+        st = stat(day_file(txt_fname))
+        done = state.get(name)
+        if name == today or (done is not None and done['size'] == st.st_size and done['mtime'] == st.st_mtime and \
+                             path.isfile(npz_name(txt_fname))):
+            continue
+        todo.append(txt_fname)
+    print ("%s: %d daily files to convert, %d up to date" % (datadir, len(todo), len(daily_files(datadir)) - len(todo)))
+    start = perf_counter()
+    rows, nbytes, nrejects = 0, 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+         open(path.join(datadir, CONVERT_REJECTS), 'w' if force else 'a') as report:
+        futures = {executor.submit(convert_file, txt_fname): txt_fname for txt_fname in todo}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                print ("%s failed: %s" % (futures[future], e))
+                continue
+            rejects = result.pop('rejects')
+            for n, line in rejects:
+                report.write(result['name'] + ':' + str(n) + '\t' + line + '\n')
+            report.flush()
+            result['rejected'] = len(rejects)
+            state[result['name']] = result
+            write_json(state_fname, state)
+            rows, nbytes, nrejects = rows + result['rows'], nbytes + result['size'], nrejects + len(rejects)
+            print ("%s %d rows %d rejected %.2f s %.0f rows/s %.1f MB/s" % (result['name'], result['rows'], \
+                   len(rejects), result['seconds'], result['rows']/max(result['seconds'], 1e-9), \
+                   result['size']*1e-6/max(result['seconds'], 1e-9)))
+    elapsed = perf_counter() - start
+    print ("total %d files %d rows %d rejected in %.1f s, %.0f rows/s %.1f MB/s" % (len(todo), rows, nrejects, \
+           elapsed, rows/max(elapsed, 1e-9), nbytes*1e-6/max(elapsed, 1e-9)))
+    if nrejects > 0:
+        print ("rejected lines are listed in " + path.join(datadir, CONVERT_REJECTS))
+    Manifest(datadir).rebuild()
+
+def write_json(fname, obj):
+    """
+    Writes obj to fname through a temporary file so readers never see a partial file
+    """
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=0)
+    replace(tmp, fname)
+
+def update_manifest(datadir, txt_fname):
+    """
+    Adds a closed daily file to the manifest of its data directory
+    """
+    manifest = Manifest(datadir)
+    manifest.load()
+    manifest.update(txt_fname)
+    manifest.save()
+
+def plan_tiers(bin_seconds):
+    """
+    Tiers that serve a binning of bin_seconds, coarsest first. None stands for calendar bins
+    like weeks or months, which are made of whole days
+    """
+    tiers = [tier for tier, seconds in TIERS.items() if bin_seconds is None or bin_seconds % seconds == 0]
+    return sorted(tiers, key=lambda tier: -TIERS[tier])
+
+def query_rollups(datadir, bin_seconds, start=None, end=None):
+    """
+    Rollup records of the buckets starting between start and end from the coarsest tiers that
+    serve bin_seconds, see plan_tiers(). A finer tier only fills in the samples after the last
+    sample of the coarser ones, e.g. the current day from the hours and minutes. Returns None
+    if no tier fits. A bucket continued after a restart has a record for each part
+    """
+    tiers = plan_tiers(bin_seconds)
+    if tiers == []:
+        return None
+    # the bucket of the coarsest tier holding start is included as a whole
+    first = None if start is None else int(bucket_starts(array([to_ns(start)], dtype=int64), TIERS[tiers[0]])[0])
+    last = None if end is None else to_ns(end)
+    out = []
+    covered = None
+    for tier in tiers:
+        recs = read_binlog(rollup_name(datadir, tier), ROLLUP)
+        times = recs['time']
+        i = 0 if first is None else int(times.searchsorted(first, side='left'))
+        j = len(recs) if last is None else int(times.searchsorted(last, side='right'))
+        if covered is not None:
+            # all tiers append their open buckets together, so a record holds either only samples
+            # of the coarser records or only later ones, e.g. the rest of an hour after a restart
+            i = max(i, int(recs['end'].searchsorted(covered, side='right')))
+        if j > i:
+            out.append(array(recs[i:j]))
+        if len(recs) > 0:
+            # the records are appended in the order of their samples, the last one holds the latest
+            covered = int(recs['end'][-1]) if covered is None else max(covered, int(recs['end'][-1]))
+    if out == []:
+        return zeros(0, dtype=ROLLUP)
+    return concatenate(out)
+
+def store_parser():
+    parser = ArgumentParser(prog='bpc_store', description='Maintain the storage formats of the bpc data directories.')
+    parser.add_argument('--manifest', help='rebuild the manifest of the data directory', metavar='DATADIR')
+    parser.add_argument('--convert', help='store every closed daily file of the data directory column wise ' + \
+                        'and rebuild its manifest, files converted before are skipped', metavar='DATADIR')
+    parser.add_argument('--workers', help='number of processes converting files, defaults to the number of CPUs', \
+                        default=None, type=int)
+    parser.add_argument('--force', help='convert all files again', action='store_true')
+    return parser
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(name)s : %(message)s')
+    opts = store_parser().parse_args()
+    if opts.convert is not None:
+        convert_archive(opts.convert, opts.workers, opts.force)
+    elif opts.manifest is not None:
+        Manifest(opts.manifest).rebuild()
+    else:
+        store_parser().print_help()
+        sys.exit(1)